@@ -13,11 +13,27 @@ import pickle
 import os
 import threading
 import queue
+import heapq
+import collections
+import re
+import uuid
+import random
+import socket
+import bisect
+import contextlib
+import http.server
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from googleapiclient.discovery import build
+    from googleapiclient.discovery import build, build_from_document
     from google_auth_oauthlib.flow import InstalledAppFlow
     from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.errors import HttpError
+    from google.auth.exceptions import RefreshError
+    import httplib2
+    import google_auth_httplib2
     MODULES_INSTALLED = True
 except ImportError:
     MODULES_INSTALLED = False
@@ -28,15 +44,60 @@ except ImportError:
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 CLIENT_CONFIG_FILENAME = 'google_calendar_client_configuration.json'
 CREDENTIAL_FILENAME = 'google_calendar_credentials.json'
+ACCOUNT_CREDENTIAL_FILENAME = 'google_calendar_credentials_{}.json'
+DEFAULT_ACCOUNT = 'default'
+DISCOVERY_FILENAME = 'google_calendar_discovery.json'
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest'
+DISCOVERY_CACHE_DAYS = 7.0
+EVENT_STORE_FILENAME = 'google_calendar_events.sqlite'
+EVENT_STORE_VERSION = 4
+EVENT_FIELDS = {'start':'TEXT', 'end':'TEXT', 'start_ts':'REAL', 'end_ts':'REAL', 'summary':'TEXT', 'description':'TEXT',
+                'status':'TEXT', 'kind':'TEXT', 'htmlLink':'TEXT', 'updated':'TEXT', 'iCalUID':'TEXT'}
+# event resource fields requested from the API - the rest only when exporting event data
+REQUIRED_ITEM_FIELDS = ('id', 'status', 'updated', 'start', 'end', 'summary')
+EXPORT_ITEM_FIELDS = ('description', 'kind', 'htmlLink', 'iCalUID')
+EVENT_DATA_EXPORT_LIMIT = 100000 # characters
+FIRED_STORE_FILENAME = 'google_calendar_fired.sqlite'
 
 LOOK_BACK_DAYS = 7
 LOOK_AHEAD_DAYS = 30
+QUERY_HOURS_DEFAULT = 2.0
 
 INITIALIZE_RETRY_MINUTES = 30.0
+TOKEN_REFRESH_MINUTES = 10.0
 CALENDAR_LIST_UPDATE_HOURS = 4.0
-DOWNLOAD_EVENTS_MINUTES = 60.0
-TRIGGER_LOOP_SECONDS = 60.0
+DOWNLOAD_EVENTS_MINUTES = 60.0 # longest interval between downloads
+MIN_REFRESH_MINUTES = 5.0
+REFRESH_BEFORE_TRIGGER_MINUTES = 5.0
+REFRESH_COALESCE_SECONDS = 15.0
+BACKOFF_BASE_SECONDS = 30.0
+BACKOFF_MAX_MINUTES = 60.0
+MAIN_LOOP_SECONDS = 60.0
+SCHEDULE_MAX_WAIT_MINUTES = 60.0
 TOO_LATE_AFTER_MINUTES = 60.0
+FULL_SYNC_HOURS = 24.0
+FIRED_COMPACT_HOURS = 24.0
+MAX_RESULTS_DEFAULT = 250
+REFRESH_THREADS_DEFAULT = 4
+REQUEST_TIMEOUT_DEFAULT = 30
+BATCH_REQUEST_LIMIT = 50
+PUSH_PORT_DEFAULT = 8765
+CHANNEL_TTL_HOURS = 24.0
+CHANNEL_RENEW_MINUTES = 60.0
+CHANNEL_RETRY_MINUTES = 30.0
+METRICS_PORT_DEFAULT = 9765
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 10000)
+
+################################################################################
+# Exceptions
+################################################################################
+class SyncTokenExpired(Exception):
+    pass
+
+################################################################################
+class DownloadStopped(Exception):
+    pass
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -46,18 +107,27 @@ class Plugin(indigo.PluginBase):
         credential_dir = os.path.join(indigo.server.getInstallFolderPath(),'Preferences/Plugins/',pluginId)
         if not os.path.exists(credential_dir):
             os.makedirs(credential_dir)
+        self.credential_dir = credential_dir
         self.client_config_path = os.path.join(credential_dir, CLIENT_CONFIG_FILENAME)
-        self.credentials_path = os.path.join(credential_dir, CREDENTIAL_FILENAME)
-        self.credentials = None
-        self.calendar_api = None
+        self.accounts = dict() # account name: GoogleAccount
+        self.discovery_path = os.path.join(credential_dir, DISCOVERY_FILENAME)
+        self.event_store = EventStore(os.path.join(credential_dir, EVENT_STORE_FILENAME), self.logger)
+        self.event_cache = EventCache(self.event_store, self.calendar_changed)
+
+        self.refresh_pool = None
+        self.refresh_futures = dict()
+        self.refresh_pending = set() # requested while a download was in flight
+        self.refresh_timers = dict() # deferred downloads, by device id
+        self.refresh_lock = threading.Lock()
+
+        self.notification_server = None
+        self.watch_channels = dict()
+        self.metrics = Metrics()
+        self.metrics_server = None
 
         self.device_dict = dict()
-        self.calendar_dict = dict()
-        self.trigger_dict = dict()
-        self.fired_trigger_dict = dict()
-
-        self._authorized = False
-        self._initialized = False
+        self.fired_store = FiredTriggerStore(os.path.join(credential_dir, FIRED_STORE_FILENAME), self.logger)
+        self.trigger_engine = TriggerEngine(self.event_cache, self.fired_store, self.metrics, self.logger)
 
     #-------------------------------------------------------------------------------
     def __del__(self):
@@ -70,20 +140,57 @@ class Plugin(indigo.PluginBase):
         self.debug = self.pluginPrefs.get('debug_logging',False)
         if self.debug:
             self.logger.debug('Debug logging enabled')
+        self.max_results = zint(self.pluginPrefs.get('maxResults', MAX_RESULTS_DEFAULT)) or MAX_RESULTS_DEFAULT
+        self.request_timeout = zint(self.pluginPrefs.get('requestTimeout', REQUEST_TIMEOUT_DEFAULT)) or REQUEST_TIMEOUT_DEFAULT
+        self.batch_requests = self.pluginPrefs.get('batchRequests', False)
+        self.start_refresh_pool(zint(self.pluginPrefs.get('refreshThreads', REFRESH_THREADS_DEFAULT)) or REFRESH_THREADS_DEFAULT)
+        self.push_enabled = self.pluginPrefs.get('pushEnabled', False)
+        self.push_address = self.pluginPrefs.get('pushAddress', '')
+        self.push_port = zint(self.pluginPrefs.get('pushPort', PUSH_PORT_DEFAULT)) or PUSH_PORT_DEFAULT
+        self.start_notification_server()
+        self.metrics_enabled = self.pluginPrefs.get('metricsEnabled', False)
+        self.metrics_port = zint(self.pluginPrefs.get('metricsPort', METRICS_PORT_DEFAULT)) or METRICS_PORT_DEFAULT
+        self.start_metrics_server()
 
         if not MODULES_INSTALLED:
             self.stopPlugin('Install the Google API Client python modules before using this plugin.  See README for details.', isError=True)
         elif not os.path.exists(self.client_config_path):
             self.stopPlugin('Copy the client configuration file to plugin directory before using this plugin.  See README for details.', isError=True)
 
-        temp_dict = json.loads(self.pluginPrefs.get('firedTriggers','{}'))
-        for key,value in temp_dict.items():
-            self.fired_trigger_dict[int(key)] = value
+        if 'firedTriggers' in self.pluginPrefs:
+            # fired triggers used to be saved in plugin prefs at shutdown
+            temp_dict = json.loads(self.pluginPrefs['firedTriggers'])
+            self.fired_store.import_legacy({int(key):value for key,value in temp_dict.items()})
+            del self.pluginPrefs['firedTriggers']
+
+        self.trigger_engine.start()
+        self.update_accounts(self.pluginPrefs.get('accounts', ''))
 
     #-------------------------------------------------------------------------------
     def shutdown(self):
+        if self.refresh_pool:
+            # drop queued downloads - running ones end after the page in flight once their device is stopped
+            self.refresh_pool.shutdown(wait=False, cancel_futures=True)
+        with self.refresh_lock:
+            for timer in self.refresh_timers.values():
+                timer.cancel()
+        self.trigger_engine.cancel()
+        for device_instance in list(self.device_dict.values()):
+            device_instance.stop()
+        for device_id in list(self.watch_channels.keys()):
+            self.stop_watch_channel(device_id)
+        for account in self.accounts.values():
+            account.cancel()
+        self.stop_notification_server()
+        self.stop_metrics_server()
+        # close the stores once nothing else is using them
+        if self.refresh_pool:
+            self.refresh_pool.shutdown(wait=True)
+        if self.trigger_engine.is_alive():
+            self.trigger_engine.join()
+        self.event_store.close()
+        self.fired_store.close()
         self.pluginPrefs['debug_logging'] = self.debug
-        self.pluginPrefs['firedTriggers'] = json.dumps(self.fired_trigger_dict)
 
     #-------------------------------------------------------------------------------
     def closedPrefsConfigUi (self, valuesDict, userCancelled):
@@ -91,11 +198,54 @@ class Plugin(indigo.PluginBase):
             self.debug = valuesDict.get('debug_logging',False)
             if self.debug:
                 self.logger.debug('Debug logging enabled')
+            self.max_results = zint(valuesDict.get('maxResults', MAX_RESULTS_DEFAULT)) or MAX_RESULTS_DEFAULT
+            self.request_timeout = zint(valuesDict.get('requestTimeout', REQUEST_TIMEOUT_DEFAULT)) or REQUEST_TIMEOUT_DEFAULT
+            self.batch_requests = valuesDict.get('batchRequests', False)
+            refresh_threads = zint(valuesDict.get('refreshThreads', REFRESH_THREADS_DEFAULT)) or REFRESH_THREADS_DEFAULT
+            if refresh_threads != self.refresh_threads:
+                self.start_refresh_pool(refresh_threads)
+            push_settings = (self.push_enabled, self.push_address, self.push_port)
+            self.push_enabled = valuesDict.get('pushEnabled', False)
+            self.push_address = valuesDict.get('pushAddress', '')
+            self.push_port = zint(valuesDict.get('pushPort', PUSH_PORT_DEFAULT)) or PUSH_PORT_DEFAULT
+            if push_settings != (self.push_enabled, self.push_address, self.push_port):
+                self.start_notification_server()
+                # channels are recreated by the main loop
+                for device_id in list(self.watch_channels.keys()):
+                    self.stop_watch_channel(device_id)
+            metrics_settings = (self.metrics_enabled, self.metrics_port)
+            self.metrics_enabled = valuesDict.get('metricsEnabled', False)
+            self.metrics_port = zint(valuesDict.get('metricsPort', METRICS_PORT_DEFAULT)) or METRICS_PORT_DEFAULT
+            if metrics_settings != (self.metrics_enabled, self.metrics_port):
+                self.start_metrics_server()
+            self.update_accounts(valuesDict.get('accounts', ''))
 
     #-------------------------------------------------------------------------------
     def validatePluginConfigUi(self, valuesDict, typeId, triggerId):
         errorsDict = indigo.Dict()
 
+        if not 1 <= zint(valuesDict.get('maxResults', MAX_RESULTS_DEFAULT)) <= 2500:
+            errorsDict['maxResults'] = 'Must be a number from 1 to 2500'
+        if not 1 <= zint(valuesDict.get('refreshThreads', REFRESH_THREADS_DEFAULT)) <= 16:
+            errorsDict['refreshThreads'] = 'Must be a number from 1 to 16'
+        if not 1 <= zint(valuesDict.get('requestTimeout', REQUEST_TIMEOUT_DEFAULT)) <= 300:
+            errorsDict['requestTimeout'] = 'Must be a number from 1 to 300'
+        if valuesDict.get('pushEnabled', False):
+            if not valuesDict.get('pushAddress', '').startswith('https://'):
+                errorsDict['pushAddress'] = 'Must be a public https:// address'
+            if not 1 <= zint(valuesDict.get('pushPort', PUSH_PORT_DEFAULT)) <= 65535:
+                errorsDict['pushPort'] = 'Must be a number from 1 to 65535'
+        account_names = split_account_names(valuesDict.get('accounts', ''))
+        if not all(re.match(r'^[\w-]+$', name) and name != DEFAULT_ACCOUNT for name in account_names):
+            errorsDict['accounts'] = f"Names may only use letters, numbers, - and _, and can't be '{DEFAULT_ACCOUNT}'"
+        elif len(set(account_names)) != len(account_names):
+            errorsDict['accounts'] = 'Names must be different'
+        if valuesDict.get('metricsEnabled', False):
+            if not 1 <= zint(valuesDict.get('metricsPort', METRICS_PORT_DEFAULT)) <= 65535:
+                errorsDict['metricsPort'] = 'Must be a number from 1 to 65535'
+            elif valuesDict.get('pushEnabled', False) and zint(valuesDict.get('metricsPort')) == zint(valuesDict.get('pushPort')):
+                errorsDict['metricsPort'] = 'Must be different from the push notification port'
+
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         else:
@@ -103,39 +253,259 @@ class Plugin(indigo.PluginBase):
 
     #-------------------------------------------------------------------------------
     def runConcurrentThread(self):
-        next_initialize_retry = 0
-        next_calendar_list_update = 0
         try:
             while True:
                 loop_time = time.time()
 
-                if not self.initialized:
-                    # confirm API initialization
-                    if loop_time > next_initialize_retry:
-                        if not self.initialize_api_client():
-                            # only schedule retry if initialation failed
-                            next_initialize_retry = loop_time + INITIALIZE_RETRY_MINUTES*60
+                for account in list(self.accounts.values()):
+                    if not account.initialized:
+                        # confirm API initialization
+                        if loop_time > account.next_initialize_retry:
+                            if not account.initialize():
+                                # only schedule retry if initialation failed
+                                account.next_initialize_retry = loop_time + INITIALIZE_RETRY_MINUTES*60
+
+                    if account.initialized:
+                        if loop_time > account.next_calendar_list_update:
+                            # update list of calendars
+                            account.get_calendars()
+                            account.next_calendar_list_update = loop_time + CALENDAR_LIST_UPDATE_HOURS*60*60
+
+                # queue calendar device updates on the refresh pool - straight away if
+                # the device's triggers now need other fields or older events
+                due_list = [instance_id for instance_id, device_instance in list(self.device_dict.items())
+                            if self.account_ready(device_instance.account, loop_time)
+                            and (loop_time > device_instance.next_update or device_instance.window_changed())]
+                if self.batch_requests:
+                    # a batch request can only use one account's credentials
+                    for account_name in set(self.device_dict[instance_id].account for instance_id in due_list):
+                        account_list = [instance_id for instance_id in due_list if self.device_dict[instance_id].account == account_name]
+                        if len(account_list) > 1:
+                            self.refresh_devices(account_list)
+                        else:
+                            self.refresh_device(account_list[0], follow_up=False)
+                else:
+                    for instance_id in due_list:
+                        self.refresh_device(instance_id, follow_up=False)
+
+                # push notification channels, with polling above as a fallback
+                self.update_watch_channels()
 
-                if self.initialized:
-                    if loop_time > next_calendar_list_update:
-                        # update list of calendars
-                        self.get_calendars()
-                        next_calendar_list_update = loop_time + CALENDAR_LIST_UPDATE_HOURS*60*60
+                self.sleep(MAIN_LOOP_SECONDS - (time.time() - loop_time))
 
-                    # update calendar devices
-                    for instance_id, device_instance in self.device_dict.items():
-                        if loop_time > device_instance.last_update + DOWNLOAD_EVENTS_MINUTES*60:
-                            device_instance.update()
-                            self.reloadTriggerCalendar(instance_id)
+        except self.StopThread:
+            pass
 
-                # evaluate triggers
-                for trigger_instance in self.trigger_dict.values():
-                    trigger_instance.queue_evaluation()
+    #-------------------------------------------------------------------------------
+    def start_refresh_pool(self, refresh_threads):
+        if self.refresh_pool:
+            # let in-flight downloads finish on the old pool
+            self.refresh_pool.shutdown(wait=False)
+        with self.refresh_lock:
+            self.refresh_futures.clear()
+        self.refresh_threads = refresh_threads
+        self.refresh_pool = ThreadPoolExecutor(max_workers=refresh_threads, thread_name_prefix='CalendarRefresh')
 
-                self.sleep(TRIGGER_LOOP_SECONDS - (time.time() - loop_time))
+    #-------------------------------------------------------------------------------
+    def refresh_device(self, device_id, follow_up=True):
+        """Queue a device download on the refresh pool, coalescing requests"""
+        with self.refresh_lock:
+            future = self.refresh_futures.get(device_id)
+            if future and not future.done():
+                # polling skips devices already downloading - only explicit requests need another
+                if follow_up:
+                    self.refresh_pending.add(device_id)
+                return
+            if device_id in self.refresh_timers:
+                return
+            device_instance = self.device_dict.get(device_id)
+            wait = device_instance.last_update + REFRESH_COALESCE_SECONDS - time.time() if device_instance else 0
+            if wait > 0:
+                self.start_refresh_timer(device_id, wait)
+            else:
+                self.refresh_futures[device_id] = self.refresh_pool.submit(self.refresh_worker, device_id)
 
-        except self.StopThread:
+    #-------------------------------------------------------------------------------
+    def start_refresh_timer(self, device_id, wait):
+        # called with refresh_lock held
+        timer = threading.Timer(wait, self.timed_refresh, (device_id,))
+        timer.daemon = True
+        self.refresh_timers[device_id] = timer
+        timer.start()
+
+    #-------------------------------------------------------------------------------
+    def timed_refresh(self, device_id):
+        with self.refresh_lock:
+            self.refresh_timers.pop(device_id, None)
+        # a download started since the request was deferred already covers it
+        self.refresh_device(device_id, follow_up=False)
+
+    #-------------------------------------------------------------------------------
+    def refresh_done(self, device_id):
+        """Follow up on requests that arrived while the device was downloading"""
+        with self.refresh_lock:
+            if device_id in self.refresh_pending:
+                self.refresh_pending.discard(device_id)
+                if device_id not in self.refresh_timers:
+                    self.start_refresh_timer(device_id, REFRESH_COALESCE_SECONDS)
+
+    #-------------------------------------------------------------------------------
+    def refresh_devices(self, device_ids):
+        """Queue one batched download for devices of the same account"""
+        with self.refresh_lock:
+            device_ids = [device_id for device_id in device_ids
+                          if not (self.refresh_futures.get(device_id) and not self.refresh_futures[device_id].done())]
+            if device_ids:
+                future = self.refresh_pool.submit(self.batch_refresh_worker, device_ids)
+                for device_id in device_ids:
+                    self.refresh_futures[device_id] = future
+
+    #-------------------------------------------------------------------------------
+    def batch_refresh_worker(self, device_ids):
+        try:
+            device_list = [self.device_dict[device_id] for device_id in device_ids if device_id in self.device_dict]
+            account = self.accounts.get(device_list[0].account) if device_list else None
+            if not account:
+                return
+            for device_id, batch_result in account.batch_get_events(device_list).items():
+                device_instance = self.device_dict.get(device_id)
+                if device_instance:
+                    device_instance.update(batch_result)
+        except Exception as e:
+            self.logger.error("Calendar batch refresh thread error")
+            self.logger.debug(f"{type(e)}: {e}")
+        finally:
+            for device_id in device_ids:
+                self.refresh_done(device_id)
+
+    #-------------------------------------------------------------------------------
+    def refresh_worker(self, device_id):
+        try:
+            device_instance = self.device_dict.get(device_id)
+            if device_instance:
+                device_instance.update()
+        except Exception as e:
+            self.logger.error(f"Calendar refresh thread error for device id {device_id}")
+            self.logger.debug(f"{type(e)}: {e}")
+        finally:
+            self.refresh_done(device_id)
+
+    #-------------------------------------------------------------------------------
+    # Push notifications
+    #-------------------------------------------------------------------------------
+    def start_notification_server(self):
+        self.stop_notification_server()
+        if self.push_enabled:
+            try:
+                self.notification_server = LocalServer(self.push_port, self.logger, notification_callback=self.push_notification)
+                self.notification_server.start()
+            except Exception as e:
+                self.logger.error(f"Unable to start push notification receiver on port {self.push_port}")
+                self.logger.debug(f"{type(e)}: {e}")
+                self.notification_server = None
+
+    #-------------------------------------------------------------------------------
+    def stop_notification_server(self):
+        if self.notification_server:
+            self.notification_server.cancel()
+            self.notification_server = None
+
+    #-------------------------------------------------------------------------------
+    def push_notification(self, channel_id, token, state):
+        """Called from the notification receiver for each Calendar API notification"""
+        device_id = zint(token)
+        channel = self.watch_channels.get(device_id)
+        if not (channel and channel['id'] == channel_id):
+            self.logger.debug(f"Ignoring notification for unknown channel {channel_id}")
+        elif state == 'sync':
+            # sent once when a channel is created
             pass
+        else:
+            self.logger.debug(f"Change notification for device id {device_id}")
+            self.refresh_device(device_id)
+
+    #-------------------------------------------------------------------------------
+    def update_watch_channels(self):
+        now = time.time()
+        for device_id, device_instance in list(self.device_dict.items()):
+            channel = self.watch_channels.get(device_id)
+            if self.push_enabled and self.notification_server and self.account_ready(device_instance.account, now) \
+                    and (not channel or channel['expiration'] < now + CHANNEL_RENEW_MINUTES*60):
+                self.watch_calendar(device_instance)
+        for device_id in list(self.watch_channels.keys()):
+            if not (self.push_enabled and device_id in self.device_dict):
+                self.stop_watch_channel(device_id)
+
+    #-------------------------------------------------------------------------------
+    def watch_calendar(self, device_instance):
+        device_id = device_instance.device.id
+        old_channel = self.watch_channels.get(device_id)
+        account = self.accounts[device_instance.account]
+        try:
+            self.metrics.count('api_calls', account=account.name, method='events.watch')
+            response = account.calendar_api.events().watch(calendarId=device_instance.calendar_id,
+                                                           body={'id'      : str(uuid.uuid4()),
+                                                                 'type'    : 'web_hook',
+                                                                 'address' : self.push_address,
+                                                                 'token'   : str(device_id),
+                                                                 'params'  : {'ttl':str(int(CHANNEL_TTL_HOURS*60*60))},
+                                                                 }).execute(http=account.get_http())
+            self.watch_channels[device_id] = {'id'         : response['id'],
+                                              'resourceId' : response['resourceId'],
+                                              'account'    : account.name,
+                                              'expiration' : zint(response.get('expiration', 0))/1000.0}
+            self.logger.debug(f"Watching calendar '{device_instance.calendar_name}' for device '{device_instance.device.name}'")
+        except Exception as e:
+            self.logger.warn(f"Unable to watch calendar '{device_instance.calendar_name}' for changes")
+            self.logger.debug(f"{type(e)}: {e}")
+            # placeholder that comes up for renewal after the retry interval
+            self.watch_channels[device_id] = {'id':None, 'resourceId':None,
+                                              'expiration':time.time() + (CHANNEL_RENEW_MINUTES + CHANNEL_RETRY_MINUTES)*60}
+        if old_channel and old_channel['id']:
+            self.stop_channel(old_channel)
+
+    #-------------------------------------------------------------------------------
+    def stop_watch_channel(self, device_id):
+        channel = self.watch_channels.pop(device_id, None)
+        if channel and channel['id']:
+            self.stop_channel(channel)
+
+    #-------------------------------------------------------------------------------
+    def stop_channel(self, channel):
+        account = self.accounts.get(channel['account'])
+        if not (account and account.calendar_api):
+            # channel will expire by itself
+            return
+        try:
+            account.calendar_api.channels().stop(body={'id':channel['id'], 'resourceId':channel['resourceId']}).execute(http=account.get_http())
+        except Exception as e:
+            # channel will expire by itself
+            self.logger.debug(f"Unable to stop channel {channel['id']}")
+            self.logger.debug(f"{type(e)}: {e}")
+
+    #-------------------------------------------------------------------------------
+    # Performance metrics
+    #-------------------------------------------------------------------------------
+    def start_metrics_server(self):
+        self.stop_metrics_server()
+        if self.metrics_enabled:
+            try:
+                self.metrics_server = LocalServer(self.metrics_port, self.logger, metrics=self.metrics)
+                self.metrics_server.start()
+            except Exception as e:
+                self.logger.error(f"Unable to start metrics endpoint on port {self.metrics_port}")
+                self.logger.debug(f"{type(e)}: {e}")
+                self.metrics_server = None
+
+    #-------------------------------------------------------------------------------
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.cancel()
+            self.metrics_server = None
+
+    #-------------------------------------------------------------------------------
+    def print_metrics(self):
+        self.logger.info(f"Performance report\n{self.metrics.report()}")
 
     #-------------------------------------------------------------------------------
     def toggle_debug(self):
@@ -152,49 +522,74 @@ class Plugin(indigo.PluginBase):
     def deviceStartComm(self, device):
         if device.configured:
             if device.deviceTypeId == 'GoogleCalendar':
-                self.device_dict[device.id] = GoogleCalendarDevice(device, self.get_events, self.logger)
+                account = self.accounts.get(device.pluginProps.get('account') or DEFAULT_ACCOUNT)
+                if not account:
+                    self.logger.error(f"'{device.name}' uses Google account '{device.pluginProps['account']}', which isn't in the plugin config")
+                    return
+                self.device_dict[device.id] = GoogleCalendarDevice(device, account.name, account.get_events, self.event_cache,
+                                                                   self.trigger_engine.next_fire_time, self.trigger_engine.requirements,
+                                                                   self.trigger_engine.set_boundary, self.metrics, self.logger)
 
     #-------------------------------------------------------------------------------
     def deviceStopComm(self, device):
         if device.id in self.device_dict:
-            del self.device_dict[device.id]
+            self.device_dict.pop(device.id).stop()
+
+    #-------------------------------------------------------------------------------
+    def deviceDeleted(self, device):
+        indigo.PluginBase.deviceDeleted(self, device)
+        self.event_cache.delete_device(device.id)
 
     #-------------------------------------------------------------------------------
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
         errorsDict = indigo.Dict()
 
+        account = self.accounts.get(valuesDict.get('account') or DEFAULT_ACCOUNT)
+        if not account:
+            errorsDict['account'] = 'Unknown account'
         if not valuesDict.get('calendarID'):
             errorsDict['calendarID'] = 'Required'
+        if not 0 <= zint(valuesDict.get('lookBackDays', LOOK_BACK_DAYS)) <= 365:
+            errorsDict['lookBackDays'] = 'Must be a number from 0 to 365'
+        if not 1 <= zint(valuesDict.get('lookAheadDays', LOOK_AHEAD_DAYS)) <= 365:
+            errorsDict['lookAheadDays'] = 'Must be a number from 1 to 365'
 
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         else:
             valuesDict['address'] = valuesDict['calendarID']
-            valuesDict['calendarName'] = self.calendar_dict.get(valuesDict['calendarID'],'')
+            valuesDict['calendarName'] = account.calendar_dict.get(valuesDict['calendarID'],'')
             return (True, valuesDict)
 
     #-------------------------------------------------------------------------------
-    # device config callback
+    # device config callbacks
+    def list_accounts(self, filter=None, valuesDict=None, typeId='', targetId=0):
+        return [(name,name) for name in self.accounts.keys()]
+
+    #-------------------------------------------------------------------------------
     def list_calendars(self, filter=None, valuesDict=None, typeId='', targetId=0):
-        return [(key,value) for key,value in self.calendar_dict.items()]
+        """Calendars of the selected account, or of every account"""
+        account_name = (valuesDict or {}).get('account')
+        calendar_list = list()
+        for account in list(self.accounts.values()):
+            if account_name in (None, account.name):
+                calendar_list.extend((key,value) for key,value in account.calendar_dict.items())
+        return calendar_list
+
+    #-------------------------------------------------------------------------------
+    def account_changed(self, valuesDict, typeId='', devId=0):
+        # reloads the calendar list
+        return valuesDict
 
     #-------------------------------------------------------------------------------
     # trigger methods
     #-------------------------------------------------------------------------------
     def triggerStartProcessing(self, trigger):
-        self.trigger_dict[trigger.id] = GoogleCalendarTrigger(trigger, self.fired_trigger_dict.get(trigger.id,[]), self.logger)
-        # start the thread
-        self.trigger_dict[trigger.id].start()
+        self.trigger_engine.add_trigger(GoogleCalendarTrigger(trigger, self.fired_store, self.logger))
 
     #-------------------------------------------------------------------------------
     def triggerStopProcessing(self, trigger):
-        if trigger.id in self.trigger_dict:
-            trigger_instance = self.trigger_dict[trigger.id]
-            self.fired_trigger_dict[trigger.id] = trigger_instance.fired_trigger_list
-            trigger_instance.cancel()
-            while trigger_instance.is_alive():
-                time.sleep(0.1)
-            del self.trigger_dict[trigger.id]
+        self.trigger_engine.remove_trigger(trigger.id)
 
     #-------------------------------------------------------------------------------
     def validateEventConfigUi(self, valuesDict, typeId, triggerId):
@@ -206,20 +601,32 @@ class Plugin(indigo.PluginBase):
             float(valuesDict.get('timeCount','0'))
         except:
             errorsDict['timeCount'] = 'Must be a number'
+        search_mode = valuesDict.get('searchMode','phrase')
+        if search_mode == 'regex':
+            try:
+                re.compile(valuesDict['searchWords'])
+            except re.error as e:
+                errorsDict['searchWords'] = f"Invalid regular expression: {e}"
 
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         else:
-            valuesDict['searchWords'] = valuesDict['searchWords'].lower()
+            if search_mode != 'regex':
+                # regex searches are case insensitive instead
+                valuesDict['searchWords'] = valuesDict['searchWords'].lower()
             if float(valuesDict.get('timeCount','0')) == 0.0:
                 time_desc = f"at {valuesDict['timeField']}"
             else:
                 time_logic = 'before' if float(valuesDict['timeCount']) >= 0.0 else 'after'
                 time_desc = f"{abs(float(valuesDict['timeCount']))}min {time_logic} {valuesDict['timeField']}"
-            if valuesDict['searchWords']:
-                event_desc = f"events with '{valuesDict['searchWords']}' in {valuesDict['searchField']}"
-            else:
+            if not valuesDict['searchWords']:
                 event_desc = "all events"
+            elif search_mode == 'regex':
+                event_desc = f"events matching /{valuesDict['searchWords']}/ in {valuesDict['searchField']}"
+            else:
+                search_logic = {'any':'any of ', 'all':'all of '}.get(search_mode, '')
+                whole_words = ' (whole words)' if valuesDict.get('wholeWords', False) else ''
+                event_desc = f"events with {search_logic}'{valuesDict['searchWords']}'{whole_words} in {valuesDict['searchField']}"
             calendar_name = indigo.devices[int(valuesDict['calendarID'])].name
             valuesDict['description'] = f"{time_desc} of {event_desc} from device '{calendar_name}'"
             return (True, valuesDict)
@@ -231,12 +638,48 @@ class Plugin(indigo.PluginBase):
         variableList.append((0,"- none -"))
         return variableList
 
+
     #-------------------------------------------------------------------------------
-    def reloadTriggerCalendar(self, device_id=None):
-        for trigger_instance in self.trigger_dict.values():
-            if (device_id == None) or (device_id == trigger_instance.calendar_id):
-                trigger_instance.reload_calendar = True
+    def calendar_changed(self, device_id):
+        self.trigger_engine.calendar_changed(device_id)
 
+    #-------------------------------------------------------------------------------
+    # actions
+    #-------------------------------------------------------------------------------
+    def query_events(self, action, device=None, callerWaitingForResult=None):
+        """Events in the next hours, for scripts using executeAction"""
+        device_instance = self.device_dict.get(action.deviceId)
+        if not device_instance:
+            self.logger.error(f"Calendar device id {action.deviceId} is not running")
+            return None
+        hours = float(action.props.get('hours', QUERY_HOURS_DEFAULT) or 0)
+        search_text = action.props.get('searchWords', '').lower()
+        with self.metrics.timer('query_seconds', calendar=action.deviceId):
+            events = device_instance.query(time.time(), hours*60*60, search_text, zint(action.props.get('maxEvents', 0)))
+        variable_id = zint(action.props.get('variableID', 0))
+        if variable_id:
+            try:
+                indigo.variable.updateValue(variable_id, json.dumps(events))
+            except:
+                self.logger.error(f"Unable to save events to variable id {variable_id} (variable may not exist)")
+        return events
+
+    #-------------------------------------------------------------------------------
+    def validateActionConfigUi(self, valuesDict, typeId, devId):
+        errorsDict = indigo.Dict()
+
+        try:
+            if float(valuesDict.get('hours', QUERY_HOURS_DEFAULT)) <= 0:
+                raise ValueError()
+        except ValueError:
+            errorsDict['hours'] = 'Must be a number greater than 0'
+        if not str(valuesDict.get('maxEvents', '0')).isdigit():
+            errorsDict['maxEvents'] = 'Must be a whole number (0 for no limit)'
+
+        if len(errorsDict) > 0:
+            return (False, valuesDict, errorsDict)
+        else:
+            return (True, valuesDict)
 
     #-------------------------------------------------------------------------------
     # action control
@@ -247,100 +690,540 @@ class Plugin(indigo.PluginBase):
         # STATUS REQUEST
         if action.deviceAction == indigo.kUniversalAction.RequestStatus:
             self.logger.info(f"'{device.name}' status update")
-            device_instance.update()
-            self.reloadTriggerCalendar(device.id)
+            self.refresh_device(device.id)
         # UNKNOWN
         else:
             self.logger.debug(f"'{dev.name}' {action.deviceAction} request ignored")
 
     #-------------------------------------------------------------------------------
-    # Google API credentials
+    # Google accounts
     #-------------------------------------------------------------------------------
-    def initialize_api_client(self):
+    def update_accounts(self, account_names):
+        """Add and remove accounts to match the plugin config"""
+        # the default account always exists and keeps the original credentials file
+        names = [DEFAULT_ACCOUNT] + split_account_names(account_names)
+        for name in names:
+            if name not in self.accounts:
+                filename = CREDENTIAL_FILENAME if name == DEFAULT_ACCOUNT else ACCOUNT_CREDENTIAL_FILENAME.format(name)
+                self.accounts[name] = GoogleAccount(name, os.path.join(self.credential_dir, filename),
+                                                    self.build_api_client, self.metrics, self.logger)
+                self.accounts[name].start()
+        for name in list(self.accounts.keys()):
+            if name not in names:
+                self.logger.info(f"Google account '{name}' removed")
+                self.accounts.pop(name).cancel()
+        for account in self.accounts.values():
+            account.max_results = self.max_results
+            account.request_timeout = self.request_timeout
+
+    #-------------------------------------------------------------------------------
+    def account_ready(self, account_name, now):
+        """Initialized and not backing off after a rate limit"""
+        account = self.accounts.get(account_name)
+        return bool(account and account.initialized and now >= account.retry_after)
+
+    #-------------------------------------------------------------------------------
+    def complete_oauth_flow(self, valuesDict=None, menuItemId=''):
+        account = self.accounts.get((valuesDict or {}).get('account') or DEFAULT_ACCOUNT)
+        if account:
+            account.complete_oauth_flow(self.client_config_path)
+        return True
+
+    #-------------------------------------------------------------------------------
+    def get_calendars(self):
+        for account in list(self.accounts.values()):
+            if account.initialized:
+                account.get_calendars()
+
+    #-------------------------------------------------------------------------------
+    def build_api_client(self):
+        """API client without credentials, from a weekly copy of the discovery document"""
+        discovery = None
+        if os.path.exists(self.discovery_path) and (time.time() < os.path.getmtime(self.discovery_path) + DISCOVERY_CACHE_DAYS*24*60*60):
+            with open(self.discovery_path, 'r') as discovery_file:
+                discovery = discovery_file.read()
+        else:
+            try:
+                response, content = httplib2.Http(timeout=self.request_timeout).request(DISCOVERY_URL)
+                if response.status != 200:
+                    raise Exception(f"HTTP status {response.status}")
+                discovery = content.decode('utf-8')
+                json.loads(discovery) # make sure it's complete before saving
+                write_file_atomic(self.discovery_path, discovery)
+                self.logger.debug(f"Google API discovery document stored in {self.discovery_path}")
+            except Exception as e:
+                self.logger.debug("Unable to download Google API discovery document")
+                self.logger.debug(f"{type(e)}: {e}")
+                if os.path.exists(self.discovery_path):
+                    # out of date is better than nothing
+                    with open(self.discovery_path, 'r') as discovery_file:
+                        discovery = discovery_file.read()
+        if discovery:
+            return build_from_document(discovery, http=httplib2.Http(timeout=self.request_timeout))
+        return build('calendar', 'v3', http=httplib2.Http(timeout=self.request_timeout))
+
+################################################################################
+# Classes
+################################################################################
+class LocalServer(threading.Thread):
+    """Receives push notifications (POST) or serves /metrics (GET)"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, port, logger, notification_callback=None, metrics=None):
+        super(LocalServer, self).__init__()
+        self.daemon = True
+        self.server = http.server.ThreadingHTTPServer(('', port), LocalRequestHandler)
+        self.server.notification_callback = notification_callback
+        self.server.metrics = metrics
+        self.server.logger = logger
+
+    #-------------------------------------------------------------------------------
+    def run(self):
+        self.server.serve_forever()
+
+    #-------------------------------------------------------------------------------
+    def cancel(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+################################################################################
+class LocalRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    #-------------------------------------------------------------------------------
+    def do_POST(self):
+        length = zint(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        if not self.server.notification_callback:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.server.notification_callback(self.headers.get('X-Goog-Channel-ID', ''),
+                                          self.headers.get('X-Goog-Channel-Token', ''),
+                                          self.headers.get('X-Goog-Resource-State', ''))
+
+    #-------------------------------------------------------------------------------
+    def do_GET(self):
+        if not (self.server.metrics and self.path.split('?')[0] == '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    #-------------------------------------------------------------------------------
+    def log_message(self, format, *args):
+        self.server.logger.debug(f"Local server: {format % args}")
+
+################################################################################
+class CredentialManager(threading.Thread):
+    """Holds the OAuth credentials and refreshes the token before it expires"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, path, on_failure, logger):
+        super(CredentialManager, self).__init__()
+        self.daemon = True
+        self.cancelled = False
+        self.wake = threading.Event()
+        self.lock = threading.Lock() # held while loading or refreshing
+
+        self.path = path
+        self.on_failure = on_failure
+        self.logger = logger
+
+        self.credentials = None
+        self.loaded = False
+        self.refresh_count = 0
+        self.force_refresh = False
+        self.failures = 0
+
+    #-------------------------------------------------------------------------------
+    def run(self):
+        while not self.cancelled:
+            self.wake.wait(self.wait_time())
+            self.wake.clear()
+            if self.cancelled or not self.loaded:
+                continue
+            credentials = self.credentials
+            if not (credentials and credentials.refresh_token):
+                continue
+            if self.force_refresh or self.expiring(credentials):
+                try:
+                    self.refresh(force=self.force_refresh)
+                    self.failures = 0
+                except RefreshError as e:
+                    # refresh token revoked or expired - the user has to authorize again
+                    self.failures += 1
+                    self.on_failure(e)
+                except Exception as e:
+                    # network problems - the current token is still good for a few minutes
+                    self.failures += 1
+                    self.logger.warn("Google API token refresh failed - will retry")
+                    self.logger.debug(f"{type(e)}: {e}")
+        else:
+            self.logger.debug("Credential manager cancelled")
+
+    #-------------------------------------------------------------------------------
+    def cancel(self):
+        self.cancelled = True
+        self.wake.set()
+
+    #-------------------------------------------------------------------------------
+    def wait_time(self):
+        if not self.loaded:
+            return None # until first use
+        if self.failures:
+            return backoff_delay(self.failures)
+        credentials = self.credentials
+        if not (credentials and credentials.expiry):
+            return BACKOFF_MAX_MINUTES*60
+        refresh_at = credentials.expiry - timedelta(minutes=TOKEN_REFRESH_MINUTES)
+        return min(max((refresh_at - datetime.utcnow()).total_seconds(), 0), BACKOFF_MAX_MINUTES*60)
+
+    #-------------------------------------------------------------------------------
+    def get(self):
+        """Credentials, loaded from the file on first use, or None if not authorized"""
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.credentials = self.load()
+                    self.loaded = True
+                    self.wake.set()
+        return self.credentials
+
+    #-------------------------------------------------------------------------------
+    def set(self, credentials):
+        """New credentials from the Oauth flow"""
+        with self.lock:
+            self.credentials = credentials
+            self.loaded = True
+            self.failures = 0
+            self.save(credentials)
+        self.wake.set()
+
+    #-------------------------------------------------------------------------------
+    def ensure_valid(self):
+        """Called before requests - only waits if the token has actually expired"""
+        credentials = self.get()
+        if credentials and not credentials.valid and credentials.refresh_token:
+            self.refresh()
+        return credentials
+
+    #-------------------------------------------------------------------------------
+    def refresh_soon(self):
+        """Token was rejected - refresh it in the background even if not expiring"""
+        self.force_refresh = True
+        self.wake.set()
+
+    #-------------------------------------------------------------------------------
+    def refresh(self, force=False):
+        count = self.refresh_count
+        # single-flight - callers wait for a refresh in progress instead of starting another
+        with self.lock:
+            if self.refresh_count != count:
+                # refreshed by another caller while this one waited
+                return
+            credentials = self.credentials
+            if not (credentials and credentials.refresh_token):
+                return
+            if not force and not self.expiring(credentials):
+                return
+            credentials.refresh(Request())
+            self.refresh_count += 1
+            self.force_refresh = False
+            self.save(credentials)
+            self.logger.debug(f"Google API access token refreshed, expires {credentials.expiry} UTC")
+
+    #-------------------------------------------------------------------------------
+    def expiring(self, credentials):
+        if not credentials.token:
+            return True
+        if not credentials.expiry:
+            return False
+        return credentials.expiry - datetime.utcnow() < timedelta(minutes=TOKEN_REFRESH_MINUTES)
+
+    #-------------------------------------------------------------------------------
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as credential_file:
+            data = credential_file.read()
         try:
-            self.get_credentials()
-            self.calendar_api = build('calendar', 'v3', credentials=self.credentials)
+            return Credentials.from_authorized_user_info(json.loads(data.decode('utf-8')), SCOPES)
+        except ValueError:
+            # older versions pickled the credentials object
+            credentials = pickle.loads(data)
+            self.save(credentials)
+            self.logger.info("Google API credentials converted to JSON")
+            return credentials
+
+    #-------------------------------------------------------------------------------
+    def save(self, credentials):
+        # token file is a secret, so only readable by this user
+        write_file_atomic(self.path, credentials.to_json(), mode=0o600)
+        self.logger.debug(f"Google API credentials stored in {self.path}")
+
+################################################################################
+class ManagedCredentials(object):
+    """Credentials for the batch code, refreshed through the credential manager"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, credential_manager):
+        self.credential_manager = credential_manager
+
+    #-------------------------------------------------------------------------------
+    @property
+    def access_token(self):
+        credentials = self.credential_manager.get()
+        return credentials.token if credentials else None
+
+    #-------------------------------------------------------------------------------
+    @property
+    def access_token_expired(self):
+        credentials = self.credential_manager.get()
+        return not (credentials and credentials.valid)
+
+    #-------------------------------------------------------------------------------
+    def refresh(self, http):
+        # a batch item got a 401
+        self.credential_manager.refresh(force=True)
+
+    #-------------------------------------------------------------------------------
+    def apply(self, headers):
+        self.credential_manager.get().apply(headers)
+
+################################################################################
+class BatchHttp(object):
+    """The thread's authorized http, with managed credentials for the batch code"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, http, credentials):
+        self.http = http
+        self.credentials = credentials
+
+    #-------------------------------------------------------------------------------
+    def request(self, *args, **kwargs):
+        return self.http.request(*args, **kwargs)
+
+################################################################################
+class GoogleAccount(object):
+    """One authorized Google account: credentials, API client and calendars"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, name, credentials_path, build_api_client, metrics, logger):
+        self.name = name
+        self.credential_manager = CredentialManager(credentials_path, self.credentials_failed, logger)
+        self.batch_credentials = ManagedCredentials(self.credential_manager)
+        self.build_api_client = build_api_client
+        self.metrics = metrics
+        self.logger = logger
+
+        self.calendar_api = None
+        self.thread_local = threading.local()
+        self.calendar_dict = dict()
+        self.max_results = MAX_RESULTS_DEFAULT
+        self.request_timeout = REQUEST_TIMEOUT_DEFAULT
+
+        self.next_initialize_retry = 0
+        self.next_calendar_list_update = 0
+        self.failures = 0      # consecutive rate limited requests
+        self.retry_after = 0   # no requests before this time
+
+        self._authorized = False
+        self._initialized = False
+
+    #-------------------------------------------------------------------------------
+    def start(self):
+        self.credential_manager.start()
+
+    #-------------------------------------------------------------------------------
+    def cancel(self):
+        self.credential_manager.cancel()
+
+    #-------------------------------------------------------------------------------
+    @property
+    def label(self):
+        return '' if self.name == DEFAULT_ACCOUNT else f" for account '{self.name}'"
+
+    #-------------------------------------------------------------------------------
+    def initialize(self):
+        try:
+            # only refreshes here if the stored token has already expired
+            credentials = self.credential_manager.ensure_valid()
+            self.authorized = bool(credentials and credentials.valid)
+            if not self.authorized:
+                if not credentials:
+                    self.logger.error(f"Complete Oauth flow{self.label} by selecting 'Authorize Access' from plugin menu.")
+                raise Exception("Google API credentials not authorized")
+            # the client is only built once - each thread makes requests with its own authorized http
+            if self.calendar_api is None:
+                self.calendar_api = self.build_api_client()
             self.initialized = True
         except Exception as e:
-            self.logger.error(f"Google API client failed to initialize - will retry in {INITIALIZE_RETRY_MINUTES} minutes")
+            self.logger.error(f"Google API client{self.label} failed to initialize - will retry in {INITIALIZE_RETRY_MINUTES} minutes")
             self.logger.debug(f"{type(e)}: {e}")
             self.initialized = False
         return self.initialized
 
     #-------------------------------------------------------------------------------
-    def get_credentials(self):
-        if os.path.exists(self.credentials_path):
-            with open(self.credentials_path, 'rb') as token:
-                self.credentials = pickle.load(token)
-        try:
-            if self.credentials and self.credentials.valid:
-                self.logger.info("Google API credentials valid")
-                self.authorized = True
-            elif self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                self.credentials.refresh(Request())
-                self.logger.info("Google API credentials refreshed")
-                self.save_credentials()
-                self.authorized = True
-            else:
-                self.authorized = False
-                self.logger.error("Complete Oauth flow by selecting 'Authorize Access' from plugin menu.")
-        except Exception as e:
-            self.logger.error("Error obtaining Google API credentials")
-            self.authorized = False
-            self.logger.debug(f"{type(e)}: {e}")
+    def api_failed(self, e, method):
+        """Only authorization failures need the API client to be re-initialized"""
+        self.metrics.count('api_errors', account=self.name, method=method, status=getattr(getattr(e, 'resp', None), 'status', 0))
+        if isinstance(e, RefreshError):
+            self.initialized = False
+        elif isinstance(e, HttpError) and e.resp.status == 401:
+            # token rejected before its expiry - devices retry once it is refreshed
+            self.credential_manager.refresh_soon()
+        elif is_rate_limited(e):
+            self.failures += 1
+            self.retry_after = time.time() + backoff_delay(self.failures)
+            self.logger.warn(f"Google API rate limit reached{self.label} - waiting {self.retry_after - time.time():.0f} seconds")
 
+    #-------------------------------------------------------------------------------
+    def api_succeeded(self):
+        self.failures = 0
 
     #-------------------------------------------------------------------------------
-    def complete_oauth_flow(self):
+    def credentials_failed(self, e):
+        """Called from the credential manager when Google refuses the refresh token"""
+        self.logger.error(f"Google API credentials refresh{self.label} failed - select 'Authorize Access' from plugin menu if this continues")
+        self.logger.debug(f"{type(e)}: {e}")
+        self.authorized = False
+        self.initialized = False
+
+    #-------------------------------------------------------------------------------
+    def complete_oauth_flow(self, client_config_path):
         if not self.authorized:
             try:
-                flow = InstalledAppFlow.from_client_secrets_file(self.client_config_path, SCOPES)
-                self.credentials = flow.run_local_server(port=0)
-                self.logger.info("Google API Oauth flow completed")
-                self.save_credentials()
+                # the browser asks which Google account to sign in to
+                flow = InstalledAppFlow.from_client_secrets_file(client_config_path, SCOPES)
+                self.credential_manager.set(flow.run_local_server(port=0))
+                self.logger.info(f"Google API Oauth flow{self.label} completed")
                 self.authorized = True
             except Exception as e:
-                self.logger.error("Google API Oauth flow failed")
+                self.logger.error(f"Google API Oauth flow{self.label} failed")
                 self.logger.debug(f"{type(e)}: {e}")
         else:
-            self.logger.info("Google API Oauth flow not needed")
+            self.logger.info(f"Google API Oauth flow{self.label} not needed")
 
     #-------------------------------------------------------------------------------
-    def save_credentials(self):
-        with open(self.credentials_path, 'wb') as token:
-            pickle.dump(self.credentials, token)
-        self.logger.info(f"Google API credentials stored in {self.credentials_path}")
+    def get_http(self):
+        """Authorized http for the calling thread - httplib2 isn't thread safe"""
+        credentials = self.credential_manager.ensure_valid()
+        key = (credentials, self.request_timeout)
+        if getattr(self.thread_local, 'key', None) != key:
+            # tokens are only refreshed by the credential manager, never by each thread's http
+            self.thread_local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=self.request_timeout),
+                                                                         refresh_status_codes=())
+            self.thread_local.key = key
+        return self.thread_local.http
 
     #-------------------------------------------------------------------------------
     def get_calendars(self):
         try:
             page_token = None
-            calendar_ids = []
             while True:
-                calendar_list = self.calendar_api.calendarList().list(pageToken=page_token).execute()
+                self.metrics.count('api_calls', account=self.name, method='calendarList.list')
+                calendar_list = self.calendar_api.calendarList().list(pageToken=page_token).execute(http=self.get_http())
                 for calendar_list_entry in calendar_list['items']:
                     self.calendar_dict[calendar_list_entry['id']] = calendar_list_entry['summary']
                 page_token = calendar_list.get('nextPageToken')
                 if not page_token:
                     break
-            self.logger.info(f"Downloaded list of {len(self.calendar_dict)} available calendars")
+            self.logger.info(f"Downloaded list of {len(self.calendar_dict)} available calendars{self.label}")
         except Exception as e:
-            self.logger.error("Failed to download list of available calendars")
+            self.logger.error(f"Failed to download list of available calendars{self.label}")
             self.logger.debug(f"{type(e)}: {e}")
-            self.initialized = False
+            self.api_failed(e, 'calendarList.list')
 
     #-------------------------------------------------------------------------------
-    def get_events(self, calendar_id, look_back, look_ahead):
-        try:
+    def events_request(self, calendar_id, look_back=None, look_ahead=None, sync_token=None, page_token=None, fields=None):
+        # partial response: only the event fields the device needs
+        fields = f"nextPageToken,nextSyncToken,timeZone,items({fields})" if fields else None
+        if sync_token:
+            # incremental sync: only changed and deleted events
+            return self.calendar_api.events().list(calendarId=calendar_id,
+                                                   syncToken=sync_token,
+                                                   singleEvents=True,
+                                                   maxResults=self.max_results,
+                                                   pageToken=page_token,
+                                                   fields=fields)
+        else:
             return self.calendar_api.events().list(calendarId=calendar_id,
                                                    timeMin=look_back,
                                                    timeMax=look_ahead,
                                                    singleEvents=True,
-                                                   orderBy='startTime').execute()
+                                                   maxResults=self.max_results,
+                                                   pageToken=page_token,
+                                                   fields=fields)
+
+    #-------------------------------------------------------------------------------
+    def get_events(self, calendar_id, look_back=None, look_ahead=None, sync_token=None, page_token=None, fields=None):
+        """Generator that yields each page of the events list as it is downloaded"""
+        try:
+            while True:
+                self.metrics.count('api_calls', account=self.name, method='events.list')
+                events_page = self.events_request(calendar_id, look_back, look_ahead, sync_token, page_token, fields).execute(http=self.get_http())
+                self.api_succeeded()
+                self.metrics.observe('page_events', len(events_page.get('items', [])), COUNT_BUCKETS)
+                yield events_page
+                page_token = events_page.get('nextPageToken')
+                if not page_token:
+                    break
         except Exception as e:
-            self.logger.warn("Calendar API call failed")
-            self.logger.debug(f"{type(e)}: {e}")
-            self.initialized = False
+            e = self.api_exception(e, sync_token)
+            if not isinstance(e, SyncTokenExpired):
+                self.logger.warn(f"Calendar API call{self.label} failed")
+                self.logger.debug(f"{type(e)}: {e}")
+                self.api_failed(e, 'events.list')
+            raise e
+
+    #-------------------------------------------------------------------------------
+    def batch_get_events(self, device_list):
+        """First pages for several devices - {device_id: (params, first_page, error)}"""
+        results = dict()
+        for index in range(0, len(device_list), BATCH_REQUEST_LIMIT):
+            params_dict = dict()
+            responses = dict()
+            def callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+            batch = self.calendar_api.new_batch_http_request(callback=callback)
+            for device_instance in device_list[index:index+BATCH_REQUEST_LIMIT]:
+                params = device_instance.sync_params()
+                params_dict[device_instance.device.id] = params
+                batch.add(self.events_request(**params), request_id=str(device_instance.device.id))
+            try:
+                self.metrics.count('api_calls', account=self.name, method='batch')
+                batch.execute(http=BatchHttp(self.get_http(), self.batch_credentials))
+                batch_error = None
+            except Exception as e:
+                self.logger.warn(f"Calendar API batch call{self.label} failed")
+                self.logger.debug(f"{type(e)}: {e}")
+                self.api_failed(e, 'batch')
+                batch_error = e
+            # a failed item only affects its own device
+            for device_id, params in params_dict.items():
+                response, exception = responses.get(str(device_id), (None, batch_error))
+                if exception:
+                    exception = self.api_exception(exception, params.get('sync_token'))
+                    if not (isinstance(exception, SyncTokenExpired) or exception is batch_error):
+                        self.api_failed(exception, 'events.list')
+                elif response:
+                    self.api_succeeded()
+                    self.metrics.observe('page_events', len(response.get('items', [])), COUNT_BUCKETS)
+                results[device_id] = (params, response, exception)
+        return results
+
+    #-------------------------------------------------------------------------------
+    def api_exception(self, e, sync_token=None):
+        if sync_token and isinstance(e, HttpError) and e.resp.status == 410:
+            # sync token invalidated by server - caller must do a full sync
+            return SyncTokenExpired(sync_token)
+        return e
 
     #-------------------------------------------------------------------------------
     def _authorized_get(self):
@@ -349,9 +1232,9 @@ class Plugin(indigo.PluginBase):
         if value != self._authorized:
             self._authorized = value
             if value:
-                self.logger.info("Google API access authorized")
+                self.logger.info(f"Google API access{self.label} authorized")
             else:
-                self.logger.error("Google API access not authorized")
+                self.logger.error(f"Google API access{self.label} not authorized")
     authorized = property(_authorized_get, _authorized_set)
 
     #-------------------------------------------------------------------------------
@@ -361,180 +1244,1028 @@ class Plugin(indigo.PluginBase):
         if value != self._initialized:
             self._initialized = value
             if value:
-                self.logger.info("Google API access initialized")
+                self.logger.info(f"Google API access{self.label} initialized")
             else:
-                self.logger.warn("Google API access not initialized - attempting reauthorization")
+                self.logger.warn(f"Google API access{self.label} not initialized - attempting reauthorization")
     initialized = property(_initialized_get, _initialized_set)
 
 ################################################################################
-# Classes
+class Metrics(object):
+    """Counters, gauges and histograms for the performance report"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.started = time.time()
+
+    #-------------------------------------------------------------------------------
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    #-------------------------------------------------------------------------------
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    #-------------------------------------------------------------------------------
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    #-------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    #-------------------------------------------------------------------------------
+    def report(self):
+        lines = [f"Collected over {(time.time() - self.started)/3600:.1f} hours"]
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(labels)}: {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{format_labels(labels)}: {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append(f"{name}{format_labels(labels)}: count {histogram.count}, mean {histogram.mean:.4g}, "
+                             f"p90 {histogram.quantile(0.9):.4g}, max {histogram.max:.4g}")
+        return '\n'.join(lines)
+
+    #-------------------------------------------------------------------------------
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        lines = list()
+        with self.lock:
+            for metric_type, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, labels in metrics}):
+                    lines.append(f"# TYPE google_calendar_{name} {metric_type}")
+                    for (metric_name, labels), value in sorted(metrics.items()):
+                        if metric_name == name:
+                            lines.append(f"google_calendar_{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append(f"# TYPE google_calendar_{name} histogram")
+                for (metric_name, labels), histogram in sorted(self.histograms.items()):
+                    if metric_name == name:
+                        cumulative = 0
+                        for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                            cumulative += count
+                            lines.append(f"google_calendar_{name}_bucket{format_labels(labels + (('le', bucket),))} {cumulative}")
+                        lines.append(f"google_calendar_{name}_sum{format_labels(labels)} {histogram.total}")
+                        lines.append(f"google_calendar_{name}_count{format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+################################################################################
+class Histogram(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    #-------------------------------------------------------------------------------
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    #-------------------------------------------------------------------------------
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the quantile"""
+        target = fraction * self.count
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bucket, self.max)
+        return self.max
+
+################################################################################
+class EventStore(object):
+    """Local SQLite copy of downloaded events"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != EVENT_STORE_VERSION:
+                # the store is only a cache of downloaded data, so just rebuild it
+                self.connection.execute('DROP TABLE IF EXISTS events')
+                self.connection.execute('DROP TABLE IF EXISTS devices')
+                self.connection.execute(f"PRAGMA user_version = {EVENT_STORE_VERSION}")
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS events (device_id INTEGER NOT NULL, event_id TEXT NOT NULL, "
+                                    f"{', '.join(field+' '+kind for field, kind in EVENT_FIELDS.items())}, PRIMARY KEY (device_id, event_id))")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_start ON events (device_id, start_ts)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_end ON events (device_id, end_ts)')
+            # event fields that were downloaded for each device's stored events
+            self.connection.execute('CREATE TABLE IF NOT EXISTS devices (device_id INTEGER PRIMARY KEY, fields TEXT NOT NULL)')
+
+    #-------------------------------------------------------------------------------
+    def get_events(self, device_id):
+        with self.lock:
+            cursor = self.connection.execute(f"SELECT event_id, {', '.join(EVENT_FIELDS)} FROM events WHERE device_id = ?", (device_id,))
+            return {row[0]:dict(zip(EVENT_FIELDS, row[1:])) for row in cursor}
+
+    #-------------------------------------------------------------------------------
+    def get_fields(self, device_id):
+        with self.lock:
+            row = self.connection.execute('SELECT fields FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+            return row[0] if row else None
+
+    #-------------------------------------------------------------------------------
+    def write_events(self, device_id, changed, deleted, fields=None):
+        """Apply one download's changes in a single transaction"""
+        if not (changed or deleted or fields):
+            return
+        with self.lock, self.connection:
+            if fields:
+                self.connection.execute('INSERT OR REPLACE INTO devices (device_id, fields) VALUES (?, ?)', (device_id, fields))
+            self.connection.executemany(f"INSERT OR REPLACE INTO events (device_id, event_id, {', '.join(EVENT_FIELDS)}) "
+                                        f"VALUES (?, ?, {', '.join('?' for field in EVENT_FIELDS)})",
+                                        [(device_id, event_id) + tuple(event[field] for field in EVENT_FIELDS) for event_id, event in changed.items()])
+            self.connection.executemany('DELETE FROM events WHERE device_id = ? AND event_id = ?',
+                                        [(device_id, event_id) for event_id in deleted])
+
+    #-------------------------------------------------------------------------------
+    def delete_device(self, device_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM events WHERE device_id = ?', (device_id,))
+            self.connection.execute('DELETE FROM devices WHERE device_id = ?', (device_id,))
+
+    #-------------------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+################################################################################
+class FiredTriggerStore(object):
+    """Events each trigger has fired for, written as triggers fire"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fired (trigger_id INTEGER NOT NULL, event_id TEXT NOT NULL, '
+                                    'start_ts REAL, fired_at REAL NOT NULL)')
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS fired_key ON fired (trigger_id, event_id, start_ts)')
+
+    #-------------------------------------------------------------------------------
+    def get_fired(self, trigger_id):
+        with self.lock:
+            cursor = self.connection.execute('SELECT event_id, start_ts FROM fired WHERE trigger_id = ?', (trigger_id,))
+            return {(event_id, start_ts) for event_id, start_ts in cursor}
+
+    #-------------------------------------------------------------------------------
+    def add(self, trigger_id, key):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO fired (trigger_id, event_id, start_ts, fired_at) VALUES (?, ?, ?, ?)',
+                                    (trigger_id, key[0], key[1], time.time()))
+
+    #-------------------------------------------------------------------------------
+    def import_legacy(self, fired_trigger_dict):
+        """Fired event ids from the old plugin prefs, which have no start times"""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO fired (trigger_id, event_id, start_ts, fired_at) VALUES (?, ?, NULL, ?)',
+                                        [(trigger_id, event_id, time.time()) for trigger_id, event_list in fired_trigger_dict.items()
+                                         for event_id in event_list])
+
+    #-------------------------------------------------------------------------------
+    def compact(self, cutoff):
+        """Anything fired before the download window can never be due again"""
+        with self.lock, self.connection:
+            count = self.connection.execute('DELETE FROM fired WHERE fired_at < ?', (cutoff,)).rowcount
+        self.logger.debug(f"Removed {count} old entries from fired trigger journal")
+
+    #-------------------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+################################################################################
+class EventCache(object):
+    """Shared in-memory events for each calendar device, backed by the event store"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, event_store, on_change):
+        self.event_store = event_store
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.calendars = dict() # device id: (generation, events) - the generation changes with the events
+
+    #-------------------------------------------------------------------------------
+    def get(self, device_id):
+        """Returns (generation, events).  The events dict must not be modified."""
+        with self.lock:
+            if device_id not in self.calendars:
+                self.calendars[device_id] = (1, self.event_store.get_events(device_id))
+            return self.calendars[device_id]
+
+    #-------------------------------------------------------------------------------
+    def get_fields(self, device_id):
+        """Event fields the stored events were downloaded with"""
+        return self.event_store.get_fields(device_id)
+
+    #-------------------------------------------------------------------------------
+    def publish(self, device_id, events, changed, deleted, fields=None, evicted=()):
+        self.event_store.write_events(device_id, changed, deleted | set(evicted), fields)
+        with self.lock:
+            generation = self.calendars.get(device_id, (0, None))[0]
+            if not (changed or deleted or device_id not in self.calendars):
+                if evicted:
+                    # ended before the window - triggers have nothing to reschedule
+                    self.calendars[device_id] = (generation, events)
+                return
+            self.calendars[device_id] = (generation + 1, events)
+        self.on_change(device_id)
+
+    #-------------------------------------------------------------------------------
+    def delete_device(self, device_id):
+        with self.lock:
+            self.calendars.pop(device_id, None)
+        self.event_store.delete_device(device_id)
+
+################################################################################
+class EventIndex(object):
+    """Events of one calendar sorted by start time, read without locking"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, events):
+        self.items = sorted(events.items(), key=lambda item: (item[1]['start_ts'], item[1]['end_ts'], item[0]))
+        self.starts = [event['start_ts'] for event_id, event in self.items]
+        # running maximum of end times - scans back for events in progress stop early
+        self.max_ends = list()
+        max_end = float('-inf')
+        for event_id, event in self.items:
+            max_end = max(max_end, event['end_ts'])
+            self.max_ends.append(max_end)
+
+    #-------------------------------------------------------------------------------
+    def current(self, now):
+        """Events in progress at now, in start order"""
+        return self.overlapping(bisect.bisect_right(self.starts, now), now)
+
+    #-------------------------------------------------------------------------------
+    def between(self, start_ts, end_ts):
+        """Events that overlap start_ts to end_ts, in start order"""
+        return self.overlapping(bisect.bisect_left(self.starts, end_ts), start_ts)
+
+    #-------------------------------------------------------------------------------
+    def overlapping(self, stop, after):
+        # events before stop that end after the given time
+        found = list()
+        index = stop - 1
+        while index >= 0 and self.max_ends[index] > after:
+            if self.items[index][1]['end_ts'] > after:
+                found.append(self.items[index])
+            index -= 1
+        found.reverse()
+        return found
+
+    #-------------------------------------------------------------------------------
+    def next_event(self, now):
+        """First event starting after now, as (event id, event)"""
+        index = bisect.bisect_right(self.starts, now)
+        return self.items[index] if index < len(self.items) else None
+
+    #-------------------------------------------------------------------------------
+    def next_boundary(self, now):
+        """Time of the next event start or end"""
+        times = [event['end_ts'] for event_id, event in self.current(now)]
+        next_item = self.next_event(now)
+        if next_item:
+            times.append(next_item[1]['start_ts'])
+        return min(times) if times else None
+
 ################################################################################
 class GoogleCalendarDevice(object):
 
     #-------------------------------------------------------------------------------
-    def __init__(self, device, get_events, logger):
+    def __init__(self, device, account, get_events, event_cache, next_fire_time, trigger_requirements, set_boundary, metrics, logger):
         self.device = device
+        self.account = account # name of the Google account that downloads the calendar
         self.states = device.states
-        if self.states['event_data']:
-            self.events = json.loads(self.states['event_data'])
-        else:
-            self.events = dict()
+        self.written = {key:value for key, value in device.states.items()} # as last sent to the server
+        self.export_stale = True
+        self.event_cache = event_cache
+        self.events = event_cache.get(device.id)[1]
+        self.index = EventIndex(self.events)
+        self.stopped = False
 
         self.get_events = get_events
+        self.next_fire_time = next_fire_time
+        self.trigger_requirements = trigger_requirements
+        self.set_boundary = set_boundary
+        self.metrics = metrics
         self.logger = logger
 
         self.calendar_id = device.pluginProps['calendarID']
         self.calendar_name = device.pluginProps['calendarName']
-
+        self.incremental = device.pluginProps.get('incrementalSync', True)
+        self.export_event_data = device.pluginProps.get('exportEventData', False)
+        self.look_back_days = zint(device.pluginProps.get('lookBackDays', LOOK_BACK_DAYS))
+        self.look_ahead_days = zint(device.pluginProps.get('lookAheadDays', LOOK_AHEAD_DAYS)) or LOOK_AHEAD_DAYS
+        self.fields = event_cache.get_fields(device.id) # fields of the stored events
+        self.window = None         # (look back seconds, fields) of the last request
+        self.synced_look_back = 0  # look back of the last full sync
+
+        self.lock = threading.Lock()
         self.last_update = 0
+        self.next_update = 0
+        self.refresh_interval = DOWNLOAD_EVENTS_MINUTES*60
+        self.failures = 0
+        self.last_full_sync = 0
+        self.sync_token = None
+        self.time_zone = None
+
+    #-------------------------------------------------------------------------------
+    def sync_params(self, full_sync=False):
+        """Arguments for the next events request - incremental when possible"""
+        look_back_seconds, fields = self.window = self.required_window()
+        now = time.time()
+        self.look_back_ts  = now - look_back_seconds
+        self.look_ahead_ts = now + self.look_ahead_days*24*60*60
+        self.look_back  = datetime.utcfromtimestamp(self.look_back_ts ).isoformat() + 'Z' # 'Z' indicates UTC time
+        self.look_ahead = datetime.utcfromtimestamp(self.look_ahead_ts).isoformat() + 'Z' # 'Z' indicates UTC time
+        # a new projection or an earlier window needs everything downloaded again
+        if (not full_sync and self.incremental and self.sync_token and fields == self.fields and look_back_seconds <= self.synced_look_back
+                and now < self.last_full_sync + FULL_SYNC_HOURS*60*60):
+            return {'calendar_id':self.calendar_id, 'sync_token':self.sync_token, 'fields':fields}
+        return {'calendar_id':self.calendar_id, 'look_back':self.look_back, 'look_ahead':self.look_ahead, 'fields':fields}
+
+    #-------------------------------------------------------------------------------
+    def required_window(self):
+        """Look back time and event fields the device needs"""
+        keep_seconds, search_fields = self.trigger_requirements(self.device.id)
+        # past events are kept while a trigger could still fire, or for the export
+        look_back_seconds = self.look_back_days*24*60*60
+        if self.export_event_data:
+            item_fields = REQUIRED_ITEM_FIELDS + EXPORT_ITEM_FIELDS
+        else:
+            look_back_seconds = min(look_back_seconds, keep_seconds)
+            item_fields = REQUIRED_ITEM_FIELDS + tuple(sorted(set(search_fields) - set(REQUIRED_ITEM_FIELDS)))
+        return look_back_seconds, ','.join(item_fields)
+
+    #-------------------------------------------------------------------------------
+    def window_changed(self):
+        return self.window is not None and self.required_window() != self.window
+
+    #-------------------------------------------------------------------------------
+    def update(self, batch_result=None):
+        """Download and merge events, continuing from a batch result if given"""
+        # runs on the refresh pool, so serialize access to the event data
+        with self.lock:
+            if self.stopped:
+                return
+            download_start = time.perf_counter()
+            try:
+                params, first_page, first_error = batch_result or (self.sync_params(), None, None)
+                full_sync = not params.get('sync_token')
+                try:
+                    change_count, sync_token = self.merge_pages(self.iter_pages(params, first_page, first_error), full_sync, params['fields'])
+                except SyncTokenExpired:
+                    self.logger.info(f"Sync token expired for device '{self.device.name}' - downloading all events")
+                    full_sync = True
+                    params = self.sync_params(full_sync)
+                    change_count, sync_token = self.merge_pages(self.get_events(**params), full_sync, params['fields'])
+                if full_sync:
+                    self.synced_look_back = self.window[0]
+
+                self.sync_token = sync_token if self.incremental else None
+
+                if self.last_changes or self.last_evicted:
+                    self.index = EventIndex(self.events)
+                if self.last_changes or self.last_evicted or self.export_stale:
+                    with self.metrics.timer('json_encode_seconds', calendar=self.device.id):
+                        self.states['event_data'] = self.event_data_export()
+                    self.export_stale = False
+                self.states['event_count']   = len(self.events)
+                self.states['download_time'] = round(time.perf_counter() - download_start, 3)
+                self.states['last_download'] = datetime.now().isoformat()
+                self.states['online']        = True
+                self.states['onOffState']    = True
+                if full_sync:
+                    self.logger.info(f"Downloaded {len(self.events)} events from calendar '{self.calendar_name}' for device '{self.device.name}'")
+                else:
+                    self.logger.info(f"Downloaded {change_count} changes from calendar '{self.calendar_name}' for device '{self.device.name}'")
+                self.schedule_update(changed=self.last_changes > 0)
+            except DownloadStopped:
+                return
+            except Exception as e:
+                self.states['online']        = False
+                self.states['onOffState']    = False
+                self.logger.warn(f"Failed to download events from calendar '{self.calendar_name}' for device '{self.device.name}'")
+                self.logger.debug(f"{type(e)}: {e}")
+                self.schedule_update(error=e)
+                self.states['download_errors'] = zint(self.states.get('download_errors', 0)) + 1
+                self.metrics.count('download_errors', calendar=self.device.id)
+            self.metrics.observe('download_seconds', time.perf_counter() - download_start, calendar=self.device.id)
+            self.metrics.gauge('stored_events', len(self.events), calendar=self.device.id)
+            self.metrics.gauge('event_data_chars', len(self.states.get('event_data', '')), calendar=self.device.id)
+            if self.stopped:
+                return
+            # stored events still answer queries while offline
+            self.states.update(self.query_states(time.time()))
+            self.write_states()
+            self.schedule_boundary()
+            self.last_update = time.time()
 
     #-------------------------------------------------------------------------------
-    def update(self):
+    def write_states(self):
+        # only send states that have changed
+        state_list = [{'key':key,'value':value} for key,value in self.states.items() if key not in self.written or self.written[key] != value]
+        if state_list:
+            self.device.updateStatesOnServer(state_list)
+            self.written.update((state['key'], state['value']) for state in state_list)
+        self.metrics.count('state_writes', len(state_list), calendar=self.device.id)
+
+    #-------------------------------------------------------------------------------
+    def query_states(self, now):
+        """The event in progress and the next event"""
+        # the latest to start, if several overlap
+        current = self.index.current(now)
+        current_event = current[-1][1] if current else None
+        next_item = self.index.next_event(now)
+        next_event = next_item[1] if next_item else None
+        return {'current_event'      : current_event['summary'] if current_event else '',
+                'current_event_end'  : current_event['end'] if current_event else '',
+                'next_event_summary' : next_event['summary'] if next_event else '',
+                'next_event_start'   : next_event['start'] if next_event else ''}
+
+    #-------------------------------------------------------------------------------
+    def schedule_boundary(self):
+        """Update the event states at the next event start or end"""
+        # called with self.lock held
+        if not self.stopped:
+            self.set_boundary(self.device.id, self.index.next_boundary(time.time()), self.boundary_reached)
+
+    #-------------------------------------------------------------------------------
+    def boundary_reached(self):
+        # called on the trigger engine thread, which mustn't wait for a download -
+        # one in progress updates these states when it finishes
+        if not self.lock.acquire(blocking=False):
+            return
         try:
-            now = datetime.utcnow()
-            look_back  = (now - timedelta(days=LOOK_BACK_DAYS )).isoformat() + 'Z' # 'Z' indicates UTC time
-            look_ahead = (now + timedelta(days=LOOK_AHEAD_DAYS)).isoformat() + 'Z' # 'Z' indicates UTC time
-            events_result = self.get_events(self.calendar_id, look_back, look_ahead)
-
-            # update event data
-            id_list = list()
-            for event in events_result.get('items', []):
-                event_id = event['id']
-                id_list.append(event_id)
-                if not event_id in self.events:
-                    self.events[event_id] = dict()
-                self.events[event_id]['start']       = event['start'].get('dateTime', event['start'].get('date'))
-                self.events[event_id]['end']         = event['end'].get('dateTime', event['end'].get('date'))
-                self.events[event_id]['summary']     = event.get('summary','').lower()
-                self.events[event_id]['description'] = event.get('description','').lower()
-                self.events[event_id]['status']      = event.get('status','')
-                self.events[event_id]['kind']        = event.get('kind','')
-                self.events[event_id]['htmlLink']    = event.get('htmlLink','')
-                self.events[event_id]['updated']     = event.get('updated','')
-                self.events[event_id]['iCalUID']     = event.get('iCalUID','')
+            if not self.stopped:
+                self.states.update(self.query_states(time.time()))
+                self.write_states()
+                self.schedule_boundary()
+        finally:
+            self.lock.release()
 
+    #-------------------------------------------------------------------------------
+    def stop(self):
+        # doesn't wait for a download in progress, which returns early once it sees this
+        self.stopped = True
+        self.set_boundary(self.device.id, None, None)
+
+    #-------------------------------------------------------------------------------
+    def query(self, now, seconds, search_text='', limit=0):
+        """Events in the next seconds whose summary contains the search text"""
+        # the index isn't locked, so scripts never wait for a download
+        result = list()
+        for event_id, event in self.index.between(now, now + seconds):
+            if search_text in event['summary'].lower():
+                result.append(dict(event, id=event_id))
+                if len(result) == limit:
+                    break
+        return result
+
+    #-------------------------------------------------------------------------------
+    def schedule_update(self, changed=False, error=None):
+        """Sooner for busy calendars and before triggers, backing off after errors"""
+        now = time.time()
+        if error is not None and is_retryable(error):
+            self.failures += 1
+            self.next_update = now + backoff_delay(self.failures)
+            self.logger.debug(f"Device '{self.device.name}' will retry in {self.next_update - now:.0f} seconds")
+            return
+        self.failures = 0
+        if error is None:
+            if changed:
+                self.refresh_interval = max(self.refresh_interval/2, MIN_REFRESH_MINUTES*60)
+            else:
+                self.refresh_interval = min(self.refresh_interval*1.5, DOWNLOAD_EVENTS_MINUTES*60)
+        next_update = now + self.refresh_interval*random.uniform(0.9, 1.0)
+        next_fire = self.next_fire_time(self.device.id)
+        if next_fire:
+            next_update = min(next_update, max(next_fire - REFRESH_BEFORE_TRIGGER_MINUTES*60, now + MIN_REFRESH_MINUTES*60))
+        self.next_update = next_update
+        self.logger.debug(f"Device '{self.device.name}' next download in {self.next_update - now:.0f} seconds")
+
+    #-------------------------------------------------------------------------------
+    def iter_pages(self, params, first_page=None, first_error=None):
+        if first_error:
+            raise first_error
+        if first_page is None:
+            yield from self.get_events(**params)
+        else:
+            # first page came from a batch request, continue with regular requests
+            yield first_page
+            if first_page.get('nextPageToken'):
+                yield from self.get_events(page_token=first_page['nextPageToken'], **params)
+
+    #-------------------------------------------------------------------------------
+    def event_data_export(self):
+        """JSON copy of the soonest events for scripts, within the size limit"""
+        if not self.export_event_data:
+            return ''
+        export = dict()
+        size = 2
+        for event_id, event in sorted(self.events.items(), key=lambda item: item[1]['start_ts']):
+            size += len(event_id) + len(json.dumps(event)) + 6
+            if size > EVENT_DATA_EXPORT_LIMIT:
+                break
+            export[event_id] = event
+        return json.dumps(export)
+
+    #-------------------------------------------------------------------------------
+    def merge_pages(self, pages, full_sync, fields):
+        """Merge pages of events into a new copy of the event dict and publish it"""
+        # stored events downloaded with other fields are all replaced
+        rebuild = fields != self.fields
+        change_count = 0
+        sync_token = None
+        # published dicts are never modified, so triggers read them without copying
+        events = dict(self.events)
+        id_list = set()
+        changed = set()
+        deleted = set()
+        evicted = set() # only dropped for falling out of the window, not a change
+        for events_page in pages:
+            if self.stopped:
+                # don't store part of a download
+                raise DownloadStopped()
+            # all-day events are dated in the calendar's own time zone
+            self.time_zone = events_page.get('timeZone', self.time_zone)
+            for event in events_page.get('items', []):
+                change_count += 1
+                event_id = event['id']
+                if event.get('status') == 'cancelled':
+                    # deleted events only appear in incremental results
+                    if events.pop(event_id, None):
+                        deleted.add(event_id)
+                    continue
+                id_list.add(event_id)
+                if not rebuild and event_id in events and events[event_id]['updated'] == event.get('updated',''):
+                    # unchanged since last download
+                    continue
+                new_event = {
+                    'start'       : event['start'].get('dateTime', event['start'].get('date')),
+                    'end'         : event['end'].get('dateTime', event['end'].get('date')),
+                    'start_ts'    : event_timestamp(event['start'], self.time_zone),
+                    'end_ts'      : event_timestamp(event['end'], self.time_zone),
+                    'summary'     : event.get('summary',''),
+                    'description' : event.get('description',''),
+                    'status'      : event.get('status',''),
+                    'kind'        : event.get('kind',''),
+                    'htmlLink'    : event.get('htmlLink',''),
+                    'updated'     : event.get('updated',''),
+                    'iCalUID'     : event.get('iCalUID',''),
+                    }
+                if event_id in events and all(events[event_id][field] == new_event[field] for field in EVENT_FIELDS if field != 'updated'):
+                    # edited in fields that aren't downloaded - nothing for triggers to reload
+                    continue
+                changed.add(event_id)
+                events[event_id] = new_event
+                if not full_sync and not in_window(events[event_id], self.look_back_ts, self.look_ahead_ts):
+                    # changed event moved outside the download window
+                    del events[event_id]
+                    changed.discard(event_id)
+                    deleted.add(event_id)
+            # only the last page carries the sync token
+            sync_token = events_page.get('nextSyncToken')
+        if full_sync:
             # remove events no longer in feed
-            for event_id in self.events.copy().keys():
-                if not event_id in id_list:
-                    del self.events[event_id]
-
-            self.states['event_data']    = json.dumps(self.events)
-            self.states['event_count']   = len(self.events)
-            self.states['last_download'] = datetime.now().isoformat()
-            self.states['online']        = True
-            self.states['onOffState']    = True
-            self.logger.info(f"Downloaded {len(self.events)} events from calendar '{self.calendar_name}' for device '{self.device.name}'")
-        except Exception as e:
-            self.states['online']        = False
-            self.states['onOffState']    = False
-            self.logger.warn(f"Failed to download events from calendar '{self.calendar_name}' for device '{self.device.name}'")
-            self.logger.debug(f"{type(e)}: {e}")
-        self.device.updateStatesOnServer([{'key':key,'value':value} for key,value in self.states.items()])
-        self.last_update = time.time()
+            for event_id in self.events.keys():
+                # cancelled items were removed as they arrived, and events that ended
+                # before the window are evicted below
+                if not event_id in id_list and event_id in events and events[event_id]['end_ts'] >= self.look_back_ts:
+                    del events[event_id]
+                    deleted.add(event_id)
+            self.last_full_sync = time.time()
+        # evict events that have ended before the window
+        for event_id in [event_id for event_id, event in events.items() if event['end_ts'] < self.look_back_ts]:
+            del events[event_id]
+            if event_id in changed:
+                changed.discard(event_id)
+                deleted.add(event_id)
+            else:
+                evicted.add(event_id)
+        self.events = events
+        self.fields = fields
+        self.last_changes = len(changed) + len(deleted)
+        self.last_evicted = len(evicted)
+        with self.metrics.timer('store_write_seconds', calendar=self.device.id):
+            self.event_cache.publish(self.device.id, events, {event_id:events[event_id] for event_id in changed}, deleted,
+                                     fields if rebuild else None, evicted)
+        return change_count, sync_token
 
 ################################################################################
-class GoogleCalendarTrigger(threading.Thread):
+class TriggerEngine(threading.Thread):
+    """Single thread that schedules and fires all triggers"""
 
     #-------------------------------------------------------------------------------
-    def __init__(self, trigger, fired_trigger_list, logger):
-        super(GoogleCalendarTrigger, self).__init__()
+    def __init__(self, event_cache, fired_store, metrics, logger):
+        super(TriggerEngine, self).__init__()
         self.daemon       = True
         self.cancelled    = False
         self.queue        = queue.Queue()
 
-        self.trigger      = trigger
-        self.id           = trigger.id
-        self.name         = trigger.name
-
-        self.calendar_id  = int(trigger.pluginProps['calendarID'])
-        self.search_words = trigger.pluginProps.get('searchWords','')
-        self.search_field = trigger.pluginProps.get('searchField','')
-        self.time_count   = zint(trigger.pluginProps.get('timeCount','0'))
-        self.time_field   = trigger.pluginProps.get('timeField','')
-        self.variable_id  = zint(trigger.pluginProps.get('variableID','0'))
-
+        self.event_cache  = event_cache
+        self.fired_store  = fired_store
+        self.metrics      = metrics
         self.logger       = logger
+        self.next_compact = 0
+
+        self.triggers = dict()          # trigger id: trigger instance
+        self.calendar_triggers = dict() # calendar device id: set of trigger ids
+        self.generations = dict()       # calendar device id: last scheduled generation
+        self.matchers = dict()          # calendar device id: EventMatcher for its triggers
+        self.fire_times = dict()        # calendar device id: sorted pending fire times
+        self.schedule = list()          # heap of (fire time, trigger id, schedule version, event id)
+        self.boundaries = dict()        # calendar device id: (time of next event start or end, callback)
+        self.boundary_schedule = list() # heap of (time, calendar device id)
 
-        self.fired_trigger_list = fired_trigger_list
-        self._events = dict()
-        self.reload_calendar = True
+        # what each calendar's triggers need downloaded - read from the refresh threads
+        self.requirements_lock = threading.Lock()
+        self.trigger_needs = dict()     # trigger id: (calendar device id, seconds after the event, search field)
 
     #-------------------------------------------------------------------------------
     def run(self):
-        self.logger.debug(f"'{self.name}' thread started")
+        self.logger.debug("Trigger engine started")
         while not self.cancelled:
             try:
-                task = self.queue.get(True,5)
-                if task == 'evaluate':
-                    self.do_evaluation()
-                elif task == 'cancel':
-                    self.cancelled = True
-                else:
-                    self.logger.error(f"'{self.name}' unrecognized task '{task}'")
+                if time.time() > self.next_compact:
+                    self.fired_store.compact(time.time() - LOOK_BACK_DAYS*24*60*60)
+                    self.next_compact = time.time() + FIRED_COMPACT_HOURS*60*60
+                self.update_schedule()
+                self.do_evaluation()
+                self.do_boundaries()
+                # sleep until the next event is due, or there is something to do
+                self.do_task(self.queue.get(True, self.wait_time()))
+                while not self.queue.empty():
+                    self.do_task(self.queue.get_nowait())
             except queue.Empty:
                 pass
             except BaseException as e:
-                self.logger.error(f"'{self.name}' thread error \n{e}")
+                self.logger.error(f"Trigger engine error \n{e}")
         else:
-            self.logger.debug(f"'{self.name}' thread cancelled")
+            self.logger.debug("Trigger engine cancelled")
+
+    #-------------------------------------------------------------------------------
+    def do_task(self, task):
+        if task[0] == 'add':
+            trigger_instance = task[1]
+            self.triggers[trigger_instance.id] = trigger_instance
+            self.calendar_triggers.setdefault(trigger_instance.calendar_id, set()).add(trigger_instance.id)
+            # rebuild the search index and reschedule the calendar
+            self.matchers.pop(trigger_instance.calendar_id, None)
+            self.generations.pop(trigger_instance.calendar_id, None)
+        elif task[0] == 'remove':
+            # stale heap entries are skipped when they come due
+            trigger_instance = self.triggers.pop(task[1], None)
+            if trigger_instance:
+                self.calendar_triggers[trigger_instance.calendar_id].discard(trigger_instance.id)
+                self.matchers.pop(trigger_instance.calendar_id, None)
+        elif task[0] == 'reload':
+            pass
+        elif task[0] == 'boundary':
+            device_id, boundary, callback = task[1:]
+            if boundary is None:
+                self.boundaries.pop(device_id, None)
+            else:
+                self.boundaries[device_id] = (boundary, callback)
+                heapq.heappush(self.boundary_schedule, (boundary, device_id))
+                # drop superseded entries once they outnumber live ones
+                if len(self.boundary_schedule) > 2*len(self.boundaries) + 100:
+                    self.boundary_schedule = [(entry[0], device_id) for device_id, entry in self.boundaries.items()]
+                    heapq.heapify(self.boundary_schedule)
+        elif task[0] == 'cancel':
+            self.cancelled = True
+        else:
+            self.logger.error(f"Trigger engine unrecognized task '{task[0]}'")
 
     #-------------------------------------------------------------------------------
     def cancel(self):
         """End this thread"""
-        self.queue.put('cancel')
+        self.queue.put(('cancel',))
+
+    #-------------------------------------------------------------------------------
+    def add_trigger(self, trigger_instance):
+        with self.requirements_lock:
+            self.trigger_needs[trigger_instance.id] = (trigger_instance.calendar_id, max(-trigger_instance.time_count*60, 0),
+                                                       trigger_instance.search_field or 'summary')
+        self.queue.put(('add', trigger_instance))
 
     #-------------------------------------------------------------------------------
-    def queue_evaluation(self):
-        self.queue.put('evaluate')
+    def remove_trigger(self, trigger_id):
+        with self.requirements_lock:
+            self.trigger_needs.pop(trigger_id, None)
+        self.queue.put(('remove', trigger_id))
+
+    #-------------------------------------------------------------------------------
+    def requirements(self, calendar_id):
+        """(look back seconds, search fields) for the calendar's triggers"""
+        with self.requirements_lock:
+            needs = [need for need in self.trigger_needs.values() if need[0] == calendar_id]
+        keep_seconds = max([need[1] for need in needs], default=0) + TOO_LATE_AFTER_MINUTES*60
+        return keep_seconds, frozenset(need[2] for need in needs)
+
+    #-------------------------------------------------------------------------------
+    def set_boundary(self, device_id, boundary, callback):
+        """Call back at the calendar's next event start or end - None cancels"""
+        self.queue.put(('boundary', device_id, boundary, callback))
+
+    #-------------------------------------------------------------------------------
+    def calendar_changed(self, device_id):
+        self.queue.put(('reload', device_id))
+
+    #-------------------------------------------------------------------------------
+    def next_fire_time(self, calendar_id):
+        """Next time a trigger on the calendar is due, or None"""
+        fire_times = self.fire_times.get(calendar_id, [])
+        index = bisect.bisect_right(fire_times, time.time())
+        return fire_times[index] if index < len(fire_times) else None
+
+    #-------------------------------------------------------------------------------
+    def wait_time(self):
+        wait = SCHEDULE_MAX_WAIT_MINUTES*60
+        if self.schedule:
+            wait = min(max(self.schedule[0][0] - time.time(), 0.0), wait)
+        if self.boundary_schedule:
+            wait = min(max(self.boundary_schedule[0][0] - time.time(), 0.0), wait)
+        return wait
+
+    #-------------------------------------------------------------------------------
+    def update_schedule(self):
+        """Reschedule the triggers of each calendar that has changed"""
+        changed = False
+        for calendar_id, trigger_ids in self.calendar_triggers.items():
+            if not trigger_ids:
+                continue
+            generation, events = self.event_cache.get(calendar_id)
+            if generation != self.generations.get(calendar_id):
+                with self.metrics.timer('schedule_seconds', calendar=calendar_id):
+                    self.schedule_calendar(calendar_id, generation, events)
+                changed = True
+        if changed:
+            # drop superseded heap entries once they outnumber live ones
+            live = sum(trigger_instance.scheduled for trigger_instance in self.triggers.values())
+            if len(self.schedule) > 2*live + 100:
+                self.schedule = [entry for entry in self.schedule
+                                 if entry[1] in self.triggers and self.triggers[entry[1]].version == entry[2]]
+                heapq.heapify(self.schedule)
+
+    #-------------------------------------------------------------------------------
+    def schedule_calendar(self, calendar_id, generation, events):
+        """Precompute fire times for all triggers on one calendar"""
+        trigger_list = [self.triggers[trigger_id] for trigger_id in self.calendar_triggers[calendar_id]]
+        matcher = self.matchers.get(calendar_id)
+        if matcher is None:
+            matcher = self.matchers[calendar_id] = EventMatcher(trigger_list)
+        matcher.prune(events)
+        for trigger_instance in trigger_list:
+            trigger_instance.version += 1
+            trigger_instance.scheduled = 0
+            trigger_instance.events = events
+            trigger_instance.prune_fired()
+        # each event is searched once for every trigger
+        fire_times = list()
+        for event_id, event in events.items():
+            for trigger_id in matcher.matches(event_id, event):
+                trigger_instance = self.triggers[trigger_id]
+                # each trigger should only fire once per event
+                if not trigger_instance.has_fired(event_id, event):
+                    time_to_fire = trigger_instance.fire_time(event)
+                    heapq.heappush(self.schedule, (time_to_fire, trigger_id, trigger_instance.version, event_id))
+                    trigger_instance.scheduled += 1
+                    fire_times.append(time_to_fire)
+        self.fire_times[calendar_id] = sorted(fire_times)
+        self.generations[calendar_id] = generation
+        self.logger.debug(f"Schedule calendar device id {calendar_id}: {len(events)} events, "
+                          f"{len(trigger_list)} triggers, {sum(t.scheduled for t in trigger_list)} pending")
 
     #-------------------------------------------------------------------------------
     def do_evaluation(self):
-        now = datetime.now(pytz.utc)
-        offset = now - datetime.now().replace(tzinfo=pytz.utc) # utc offset for current system time
-        ct_pending = ct_matched = ct_too_late = ct_fired = 0
-        for event_id,event in self.events.items():
-            # each trigger should only fire once per event
-            if event_id not in self.fired_trigger_list:
-                ct_pending += 1
-                # search for text
-                if self.search_words in event[self.search_field]:
-                    ct_matched += 1
-                    # check the time
-                    time_event = dateutil.parser.parse(event[self.time_field])
-                    if time_event.tzinfo is None:
-                        time_event = time_event.replace(tzinfo=pytz.utc) + offset
-                    time_to_fire = time_event - timedelta(minutes=self.time_count)
-                    time_too_late = time_to_fire + timedelta(minutes=TOO_LATE_AFTER_MINUTES)
-                    if (now >= time_too_late):
-                        ct_too_late += 1
-                    elif (now >= time_to_fire):
-                        ct_fired += 1
-                        self.logger.debug(f"Fire trigger '{self.name} for event '{event['summary']:.20}'")
-                        self.fired_trigger_list.append(event_id)
-                        if self.variable_id:
-                            try:
-                                indigo.variable.updateValue(self.variable_id, event['summary'])
-                                self.logger.debug(f"Save event '{event['summary']:.20}' to variable '{indigo.variables[self.variable_id].name}'")
-                            except:
-                                self.logger.error(f"Unable to save event '{event['summary']:.20}' to variable id {self.variable_id} (variable may not exist)")
-                        indigo.trigger.execute(self.id)
-        self.logger.debug(f"Evaluate trigger '{self.name}': {len(self.events)} events, {ct_pending} pending, {ct_matched} matched, {ct_too_late} too late, {ct_fired} fired")
+        now = time.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            time_to_fire, trigger_id, version, event_id = heapq.heappop(self.schedule)
+            trigger_instance = self.triggers.get(trigger_id)
+            if trigger_instance and trigger_instance.version == version:
+                trigger_instance.scheduled -= 1
+                with self.metrics.timer('trigger_evaluate_seconds', trigger=trigger_instance.id):
+                    fired = trigger_instance.evaluate(event_id, time_to_fire, now)
+                if fired:
+                    # how late the trigger fired compared to its scheduled time
+                    self.metrics.observe('fire_lag_seconds', time.time() - time_to_fire, trigger=trigger_instance.id)
+                    self.metrics.count('triggers_fired', trigger=trigger_instance.id)
 
+    #-------------------------------------------------------------------------------
+    def do_boundaries(self):
+        now = time.time()
+        while self.boundary_schedule and self.boundary_schedule[0][0] <= now:
+            boundary, device_id = heapq.heappop(self.boundary_schedule)
+            entry = self.boundaries.get(device_id)
+            if entry and entry[0] == boundary:
+                del self.boundaries[device_id]
+                try:
+                    entry[1]()
+                except Exception as e:
+                    self.logger.error(f"Event state update error for device id {device_id}")
+                    self.logger.debug(f"{type(e)}: {e}")
+
+################################################################################
+class EventMatcher(object):
+    """Matches events against the searches of all triggers on one calendar"""
 
     #-------------------------------------------------------------------------------
-    @property
-    def events(self):
-        if self.reload_calendar:
-            # grab the latest download of events
-            calendar_dev = indigo.devices[self.calendar_id]
-            self._events = json.loads(calendar_dev.states['event_data'])
-            self.logger.debug(f"Trigger '{self.name}' updated event list from '{calendar_dev.name}'")
-            # prune the list of previously-fired triggers
-            for event_id in self.fired_trigger_list:
-                if event_id not in self._events:
-                    self.fired_trigger_list.remove(event_id)
-            self.reload_calendar = False
-        return self._events
+    def __init__(self, trigger_list):
+        self.trigger_list = trigger_list
+        self.searches = dict()
+        for trigger_instance in trigger_list:
+            self.searches.setdefault(trigger_instance.search_field, set()).update(trigger_instance.search_terms)
+        self.searches = {field:AhoCorasick(terms) for field, terms in self.searches.items()}
+        self.cache = dict() # event id: (searched field values, frozenset of trigger ids)
+
+    #-------------------------------------------------------------------------------
+    def matches(self, event_id, event):
+        key = tuple(event[field] for field in self.searches)
+        cached = self.cache.get(event_id)
+        if cached and cached[0] == key:
+            return cached[1]
+        # events keep their original text for display - search terms are lower case
+        found = {field:search.search(event[field].lower()) for field, search in self.searches.items()}
+        matched = frozenset(trigger_instance.id for trigger_instance in self.trigger_list
+                            if trigger_instance.matches(event, *found[trigger_instance.search_field]))
+        self.cache[event_id] = (key, matched)
+        return matched
+
+    #-------------------------------------------------------------------------------
+    def prune(self, events):
+        for event_id in list(self.cache.keys()):
+            if event_id not in events:
+                del self.cache[event_id]
+
+################################################################################
+class AhoCorasick(object):
+    """Finds every occurrence of a set of terms in a single pass over the text"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, terms):
+        self.goto   = [dict()]
+        self.fail   = [0]
+        self.output = [[]]
+        for term in terms:
+            node = 0
+            for char in term:
+                if char not in self.goto[node]:
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(term)
+        # failure links, breadth first
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                pending.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail if fail != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    #-------------------------------------------------------------------------------
+    def search(self, text):
+        """Returns (terms found anywhere, terms found as whole words)"""
+        found = set()
+        found_words = set()
+        if len(self.goto) == 1:
+            return found, found_words
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for term in self.output[node]:
+                found.add(term)
+                start = index - len(term) + 1
+                if (start == 0 or not is_word_char(text[start-1])) and (index+1 == len(text) or not is_word_char(text[index+1])):
+                    found_words.add(term)
+        return found, found_words
+
+################################################################################
+class GoogleCalendarTrigger(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, trigger, fired_store, logger):
+        self.trigger      = trigger
+        self.id           = trigger.id
+        self.name         = trigger.name
+
+        self.calendar_id  = int(trigger.pluginProps['calendarID'])
+        self.search_words = trigger.pluginProps.get('searchWords','')
+        self.search_field = trigger.pluginProps.get('searchField','')
+        self.search_mode  = trigger.pluginProps.get('searchMode','phrase')
+        self.whole_words  = trigger.pluginProps.get('wholeWords',False)
+        self.time_count   = zint(trigger.pluginProps.get('timeCount','0'))
+        self.time_field   = trigger.pluginProps.get('timeField','')
+        self.variable_id  = zint(trigger.pluginProps.get('variableID','0'))
+
+        self.logger       = logger
+
+        # search terms are compiled once, into the calendar's EventMatcher
+        self.search_regex = None
+        self.search_terms = []
+        if self.search_mode == 'regex':
+            if self.search_words:
+                self.search_regex = re.compile(self.search_words, re.IGNORECASE)
+        elif self.search_mode in ('any','all'):
+            self.search_terms = self.search_words.split()
+        elif self.search_words:
+            self.search_terms = [self.search_words]
+
+        self.fired_store = fired_store
+        self.fired = fired_store.get_fired(self.id) # set of (event id, start time)
+        self.events = dict()
+        self.version = 0   # incremented each time the trigger is rescheduled
+        self.scheduled = 0 # live entries in the engine's heap
+
+    #-------------------------------------------------------------------------------
+    def prune_fired(self):
+        # forget fired events that are no longer on the calendar - the journal is compacted separately
+        self.fired = {key for key in self.fired if key[0] in self.events}
+
+    #-------------------------------------------------------------------------------
+    def has_fired(self, event_id, event):
+        # start time None is a fired event carried over from the old plugin prefs
+        return ((event_id, event['start_ts']) in self.fired) or ((event_id, None) in self.fired)
+
+    #-------------------------------------------------------------------------------
+    def fire_time(self, event):
+        return event[self.time_field+'_ts'] - self.time_count*60
+
+    #-------------------------------------------------------------------------------
+    def matches(self, event, found, found_words):
+        """found and found_words are the search terms present in the search field"""
+        if self.search_regex:
+            return bool(self.search_regex.search(event[self.search_field]))
+        if not self.search_terms:
+            return True
+        hits = found_words if self.whole_words else found
+        if self.search_mode == 'all':
+            return all(term in hits for term in self.search_terms)
+        return any(term in hits for term in self.search_terms)
+
+    #-------------------------------------------------------------------------------
+    def evaluate(self, event_id, time_to_fire, now):
+        event = self.events[event_id]
+        if self.has_fired(event_id, event):
+            return False
+        if now >= time_to_fire + TOO_LATE_AFTER_MINUTES*60:
+            # too late
+            return False
+        self.logger.debug(f"Fire trigger '{self.name} for event '{event['summary']:.20}'")
+        key = (event_id, event['start_ts'])
+        self.fired.add(key)
+        self.fired_store.add(self.id, key)
+        if self.variable_id:
+            try:
+                indigo.variable.updateValue(self.variable_id, event['summary'])
+                self.logger.debug(f"Save event '{event['summary']:.20}' to variable '{indigo.variables[self.variable_id].name}'")
+            except:
+                self.logger.error(f"Unable to save event '{event['summary']:.20}' to variable id {self.variable_id} (variable may not exist)")
+        indigo.trigger.execute(self.id)
+        return True
 
 
 ################################################################################
@@ -543,3 +2274,77 @@ class GoogleCalendarTrigger(threading.Thread):
 def zint(value):
     try: return int(value)
     except: return 0
+
+#-------------------------------------------------------------------------------
+def write_file_atomic(path, data, mode=None):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as temp_file:
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+#-------------------------------------------------------------------------------
+def is_retryable(e):
+    """Rate limits, server errors and network problems"""
+    if isinstance(e, HttpError):
+        if e.resp.status in (500, 502, 503, 504):
+            return True
+        if e.resp.status == 401:
+            # the credential manager refreshes the token in the meantime
+            return True
+        return is_rate_limited(e)
+    return isinstance(e, (socket.timeout, ConnectionError, httplib2.HttpLib2Error))
+
+#-------------------------------------------------------------------------------
+def backoff_delay(failures):
+    """Seconds to wait after consecutive failures, with jitter"""
+    delay = min(BACKOFF_BASE_SECONDS * 2**failures, BACKOFF_MAX_MINUTES*60)
+    return random.uniform(delay/2, delay)
+
+#-------------------------------------------------------------------------------
+def is_rate_limited(e):
+    """Quota errors, which apply to the whole account rather than one calendar"""
+    if isinstance(e, HttpError):
+        if e.resp.status == 429:
+            return True
+        if e.resp.status == 403:
+            content = e.content.decode('utf-8', 'ignore') if isinstance(e.content, bytes) else str(e.content)
+            return any(reason in content for reason in ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'))
+    return False
+
+#-------------------------------------------------------------------------------
+def split_account_names(account_names):
+    return [name.strip() for name in account_names.split(',') if name.strip()]
+
+#-------------------------------------------------------------------------------
+def format_labels(labels):
+    if not labels:
+        return ''
+    values = list()
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append(f'{key}="{value}"')
+    return '{' + ','.join(values) + '}'
+
+#-------------------------------------------------------------------------------
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+#-------------------------------------------------------------------------------
+def in_window(event, look_back_ts, look_ahead_ts):
+    return (event['end_ts'] >= look_back_ts) and (event['start_ts'] <= look_ahead_ts)
+
+#-------------------------------------------------------------------------------
+def event_timestamp(event_time, time_zone):
+    """Epoch time of an event start or end - all-day events start at local midnight"""
+    if 'dateTime' in event_time:
+        timestamp = dateutil.parser.parse(event_time['dateTime'])
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=pytz.utc)
+        return timestamp.timestamp()
+    try:
+        zone = pytz.timezone(event_time.get('timeZone') or time_zone or 'UTC')
+    except pytz.UnknownTimeZoneError:
+        zone = pytz.utc
+    return zone.localize(datetime.strptime(event_time['date'], '%Y-%m-%d')).timestamp()
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks GoogleAccount.batch_get_events against a stub HTTP transport.
+
+The benchmark's fake service skips googleapiclient's batch code entirely.  Here
+the real client library builds the multipart batch request and parses the
+multipart response, so per-item results are dispatched exactly as they would be
+from Google: a page for one calendar, a 410 (expired sync token) for another, a
+404 for a third, and a 401 that the library retries once the credential manager
+has refreshed the token.
+
+    python3 benchmark/check_batch.py
+"""
+
+import email.parser
+import http.client
+import json
+import logging
+import os
+import sys
+import tempfile
+import types
+import urllib.parse
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+import googleapiclient.discovery_cache
+
+from run_benchmark import load_plugin_module
+
+DISCOVERY_PATH = os.path.join(os.path.dirname(googleapiclient.discovery_cache.__file__), 'documents', 'calendar.v3.json')
+FIELDS = 'id,status,updated,start,end,summary'
+
+################################################################################
+class FakeCredentials(object):
+    """Just enough of google.oauth2 Credentials for the credential manager and AuthorizedHttp"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, token):
+        self.token = token
+        self.refresh_token = 'refresh'
+        self.expiry = None
+        self.valid = True
+        self.refreshes = 0
+
+    #-------------------------------------------------------------------------------
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"{self.token}-refreshed"
+
+    #-------------------------------------------------------------------------------
+    def apply(self, headers, token=None):
+        headers['authorization'] = f"Bearer {self.token}"
+
+    #-------------------------------------------------------------------------------
+    def before_request(self, request, method, url, headers):
+        self.apply(headers)
+
+    #-------------------------------------------------------------------------------
+    def to_json(self):
+        return json.dumps({'token':self.token, 'refresh_token':self.refresh_token})
+
+################################################################################
+class BatchTransport(object):
+    """Stands in for httplib2.Http.  Answers each item of a multipart batch request
+    from a script of (status, body) responses for its calendar, and records what was
+    sent."""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, script):
+        self.script = script # calendar id: list of (status, body), one per request
+        self.requests = list() # (outer headers, [(calendar id, item headers)])
+
+    #-------------------------------------------------------------------------------
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        message = email.parser.Parser().parsestr(f"Content-Type: {headers['content-type']}\r\n\r\n{body}")
+        items = list()
+        parts = list()
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            item_headers = email.parser.Parser().parsestr(rest, headersonly=True)
+            calendar_id = urllib.parse.unquote(request_line.split()[1].split('/')[4])
+            items.append((calendar_id, dict(item_headers.items())))
+            status, content = self.script[calendar_id].pop(0)
+            parts.append(f"--batch_boundary\r\nContent-Type: application/http\r\n"
+                         f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                         f"HTTP/1.1 {status} {http.client.responses[status]}\r\n"
+                         f"Content-Type: application/json\r\n\r\n{json.dumps(content)}\r\n")
+        self.requests.append((dict(headers), items))
+        response = httplib2.Response({'status':'200', 'content-type':'multipart/mixed; boundary=batch_boundary'})
+        return response, (''.join(parts) + '--batch_boundary--').encode('utf-8')
+
+#-------------------------------------------------------------------------------
+def page(*summaries):
+    return {'timeZone':'Europe/London', 'nextSyncToken':'next',
+            'items':[{'id':f"ev{index}", 'status':'confirmed', 'updated':'2024-01-01T00:00:00.000Z', 'summary':summary,
+                      'start':{'dateTime':'2024-01-02T09:00:00Z'}, 'end':{'dateTime':'2024-01-02T10:00:00Z'}}
+                     for index, summary in enumerate(summaries)]}
+
+#-------------------------------------------------------------------------------
+def error(status, reason):
+    return {'error':{'code':status, 'message':reason, 'errors':[{'reason':reason}]}}
+
+#-------------------------------------------------------------------------------
+def device(device_id, calendar_id, sync_token=None):
+    params = {'calendar_id':calendar_id, 'fields':FIELDS}
+    if sync_token:
+        params['sync_token'] = sync_token
+    else:
+        params.update(look_back='2024-01-01T00:00:00Z', look_ahead='2024-02-01T00:00:00Z')
+    return types.SimpleNamespace(device=types.SimpleNamespace(id=device_id), sync_params=lambda: params)
+
+#-------------------------------------------------------------------------------
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print(f"ok   {message}")
+
+#-------------------------------------------------------------------------------
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    module = load_plugin_module()
+    with open(DISCOVERY_PATH, 'r') as discovery_file:
+        discovery = discovery_file.read()
+    with tempfile.TemporaryDirectory(prefix='indigo_check_') as folder:
+        credentials_path = os.path.join(folder, 'credentials.json')
+        account = module.GoogleAccount(module.DEFAULT_ACCOUNT, credentials_path,
+                                       lambda: build_from_document(discovery, http=httplib2.Http()),
+                                       module.Metrics(), logging.getLogger('Plugin'))
+        first = FakeCredentials('first')
+        account.credential_manager.set(first)
+        check(account.initialize(), "account initializes with stored credentials")
+
+        transport = BatchTransport({'home'  : [(200, page('Dentist', 'School run'))],
+                                    'work'  : [(410, error(410, 'fullSyncRequired'))],
+                                    'gone'  : [(404, error(404, 'notFound'))],
+                                    'flaky' : [(401, error(401, 'authError')), (200, page('Standup'))]})
+        # every http the account makes talks to the stub
+        module.httplib2 = types.SimpleNamespace(Http=lambda timeout=None: transport, HttpLib2Error=httplib2.HttpLib2Error)
+
+        results = account.batch_get_events([device(1, 'home'), device(2, 'work', sync_token='old'),
+                                            device(3, 'gone'), device(4, 'flaky', sync_token='old')])
+        params, response, exception = results[1]
+        check(exception is None and [item['summary'] for item in response['items']] == ['Dentist', 'School run'],
+              "200 item returns its page")
+        check(isinstance(results[2][2], module.SyncTokenExpired), "410 item with a sync token becomes SyncTokenExpired")
+        check(isinstance(results[3][2], module.HttpError) and results[3][2].resp.status == 404, "404 item fails only its own device")
+        check(results[4][2] is None and results[4][1]['items'][0]['summary'] == 'Standup', "401 item succeeds when retried")
+
+        outer_headers, items = transport.requests[0]
+        check(len(transport.requests) == 2 and [calendar_id for calendar_id, headers in transport.requests[1][1]] == ['flaky'],
+              "only the 401 item is sent again")
+        check(outer_headers['authorization'] == 'Bearer first' and not any('authorization' in headers for calendar_id, headers in items),
+              "batch is authorized by the thread's http, not by credentials held in the client")
+        check(first.refreshes == 1 and account.credential_manager.refresh_count == 1,
+              "401 retry refreshes once, through the credential manager")
+        check(json.load(open(credentials_path))['token'] == 'first-refreshed', "refreshed token is saved")
+        check(transport.requests[1][0]['authorization'] == 'Bearer first-refreshed', "retry batch is sent with the refreshed token")
+
+        # Authorize Access replaces the credentials object
+        account.credential_manager.set(FakeCredentials('second'))
+        transport.script['home'].append((200, page('Lunch')))
+        results = account.batch_get_events([device(1, 'home')])
+        check(results[1][2] is None and transport.requests[-1][0]['authorization'] == 'Bearer second',
+              "next batch uses the new credentials")
+
+################################################################################
+if __name__ == '__main__':
+    try:
+        main()
+    except AssertionError as e:
+        print(f"FAIL {e}")
+        sys.exit(1)
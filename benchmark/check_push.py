@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks push notifications end to end with a local fake notifier.
+
+Starts the plugin's notification receiver on a free local port, watches two
+calendars through the fake Calendar API, then POSTs notifications with the
+X-Goog-Channel-* headers Google sends.  Only a change notification for a known
+channel should queue its device for download.  The initial 'sync' message,
+stale channels and unknown tokens are all ignored.
+
+    python3 benchmark/check_push.py
+"""
+
+import socket
+import sys
+import time
+import types
+import urllib.request
+
+from run_benchmark import Benchmark
+from fake_calendar import FakeCalendarService
+
+################################################################################
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('', 0))
+        return probe.getsockname()[1]
+
+#-------------------------------------------------------------------------------
+def notify(port, channel_id, token, state):
+    """POST a notification as Google does - all the information is in the headers"""
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/", data=b'', method='POST',
+                                     headers={'X-Goog-Channel-ID'     : channel_id,
+                                              'X-Goog-Channel-Token'  : token,
+                                              'X-Goog-Resource-State' : state,
+                                              'X-Goog-Resource-ID'    : 'resource',
+                                              'X-Goog-Message-Number' : '1'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status
+
+#-------------------------------------------------------------------------------
+def queued(plugin, device_id, wait=0.5):
+    """Whether a download was queued for the device - the receiver calls back after responding"""
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if device_id in plugin.refresh_futures or device_id in plugin.refresh_timers:
+            return True
+        time.sleep(0.02)
+    return False
+
+#-------------------------------------------------------------------------------
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print(f"ok   {message}")
+
+#-------------------------------------------------------------------------------
+def main():
+    args = types.SimpleNamespace(page_size=250, threads=2, export=False)
+    benchmark = Benchmark(args)
+    service = FakeCalendarService()
+    plugin = benchmark.make_plugin(service)
+    try:
+        known, other = benchmark.add_calendars(plugin, service, 2, 10)
+        # the refresh pool would download straight away - keep the queue to inspect it
+        plugin.refresh_pool.submit = lambda *args: types.SimpleNamespace(done=lambda: False)
+
+        plugin.push_enabled = True
+        plugin.push_address = 'https://calendar.example.com/notify'
+        plugin.push_port = free_port()
+        plugin.start_notification_server()
+        check(plugin.notification_server is not None, f"receiver listening on port {plugin.push_port}")
+
+        plugin.update_watch_channels()
+        channel = plugin.watch_channels.get(known.id)
+        check(channel and channel['id'] and plugin.watch_channels.get(other.id, {}).get('id'), "both calendars are watched")
+
+        check(notify(plugin.push_port, channel['id'], str(known.id), 'sync') == 200 and not queued(plugin, known.id),
+              "'sync' message for a new channel is acknowledged but not downloaded")
+        check(notify(plugin.push_port, 'stale-channel', str(other.id), 'exists') == 200 and not queued(plugin, other.id),
+              "notification from an unknown channel is ignored")
+        check(notify(plugin.push_port, channel['id'], '999999', 'exists') == 200 and not queued(plugin, 999999),
+              "notification with an unknown token is ignored")
+        check(notify(plugin.push_port, channel['id'], str(known.id), 'exists') == 200 and queued(plugin, known.id),
+              "change notification for a known channel queues its device")
+        check(not queued(plugin, other.id, wait=0.1), "other devices are not queued")
+    finally:
+        benchmark.close_plugin(plugin)
+
+################################################################################
+if __name__ == '__main__':
+    try:
+        main()
+    except AssertionError as e:
+        print(f"FAIL {e}")
+        sys.exit(1)
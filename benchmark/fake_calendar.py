@@ -0,0 +1,321 @@
+"""In-memory fake of the parts of the Google Calendar v3 API the plugin uses:
+calendarList().list, events().list (time window, sync tokens, pagination and
+fields= partial responses), events().watch, channels().stop and batch requests.
+Calendars are filled with synthetic events - one-off, all-day and expanded
+recurring series."""
+
+import random
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+import pytz
+from googleapiclient.errors import HttpError
+
+WORDS = ('meeting', 'standup', 'review', 'lunch', 'dentist', 'school', 'holiday', 'gym', 'bins',
+         'garden', 'party', 'call', 'flight', 'train', 'doctor', 'football', 'piano', 'shopping')
+
+################################################################################
+def http_error(status, reason=''):
+    return HttpError(httplib2.Response({'status':status}), reason.encode('utf-8'))
+
+#-------------------------------------------------------------------------------
+def rfc3339(timestamp):
+    return datetime.fromtimestamp(timestamp, pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+#-------------------------------------------------------------------------------
+def parse_fields(fields):
+    """'a,b,items(c,d)' as {'a':None, 'b':None, 'items':{'c':None, 'd':None}}"""
+    parsed = dict()
+    stack = [parsed]
+    name = ''
+    for char in fields + ',':
+        if char == '(':
+            stack[-1][name.strip()] = dict()
+            stack.append(stack[-1][name.strip()])
+            name = ''
+        elif char in ',)':
+            if name.strip():
+                stack[-1][name.strip()] = None
+            name = ''
+            if char == ')':
+                stack.pop()
+        else:
+            name += char
+    return parsed
+
+#-------------------------------------------------------------------------------
+def project(resource, fields):
+    """Partial response - only the requested fields, as the API does for fields="""
+    if not fields:
+        return resource
+    def apply(value, selection):
+        if selection is None:
+            return value
+        if isinstance(value, list):
+            return [apply(item, selection) for item in value]
+        return {key:apply(value[key], selection[key]) for key in selection if key in value}
+    return apply(resource, parse_fields(fields))
+
+################################################################################
+class FakeCalendar(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, calendar_id, summary, rng, time_zone='Europe/London'):
+        self.id = calendar_id
+        self.summary = summary
+        self.rng = rng
+        self.time_zone = time_zone
+        self.events = dict()     # event id: event resource
+        self.times = dict()       # event id: epoch (start, end), for window filtering
+        self.sequence = 0
+        self.changes = dict()     # event id: sequence number of last change
+        self.oldest_token = 0     # sync tokens older than this get a 410
+        self.next_id = 0
+
+    #-------------------------------------------------------------------------------
+    def populate(self, count, now, look_back_days=7, look_ahead_days=30, all_day_share=0.1, recurring_share=0.3):
+        """Synthetic events spread over the download window"""
+        start = now - look_back_days*24*60*60
+        span = (look_back_days + look_ahead_days)*24*60*60
+        recurring = int(count * recurring_share)
+        all_day = int(count * all_day_share)
+        while recurring > 0:
+            # daily or weekly series, expanded as singleEvents=true would return them
+            period = self.rng.choice((1, 7))
+            instances = max(1, min(recurring, int(span // (period*24*60*60))))
+            first = start + self.rng.uniform(0, period*24*60*60)
+            series_id = self.new_id()
+            summary = self.summary_text()
+            for index in range(instances):
+                instance_start = first + index*period*24*60*60
+                event = self.timed_event(f"{series_id}_{rfc3339(instance_start).replace('-','').replace(':','')}",
+                                         instance_start, 30*60, summary)
+                event['recurringEventId'] = series_id
+                self.put(event, instance_start, instance_start + 30*60)
+            recurring -= instances
+        for index in range(all_day):
+            day = datetime.fromtimestamp(start + self.rng.uniform(0, span), pytz.timezone(self.time_zone)).date()
+            event = self.base_event(self.new_id(), self.summary_text())
+            event['start'] = {'date':day.isoformat()}
+            event['end'] = {'date':(day + timedelta(days=1)).isoformat()}
+            midnight = pytz.timezone(self.time_zone).localize(datetime(day.year, day.month, day.day)).timestamp()
+            self.put(event, midnight, midnight + 24*60*60)
+        for index in range(count - len(self.events)):
+            self.add_event(self.summary_text(), start + self.rng.uniform(0, span), self.rng.choice((15, 30, 60, 120))*60)
+        # populating doesn't count as changes
+        self.changes.clear()
+        self.oldest_token = self.sequence
+
+    #-------------------------------------------------------------------------------
+    def add_event(self, summary, event_start, duration=30*60):
+        event_id = self.new_id()
+        self.put(self.timed_event(event_id, event_start, duration, summary), event_start, event_start + duration)
+        return event_id
+
+    #-------------------------------------------------------------------------------
+    def churn(self, fraction):
+        """Edit, move, delete and add a fraction of the events, as users would"""
+        count = max(1, int(len(self.events) * fraction))
+        for event_id in self.rng.sample(sorted(self.events), min(count, len(self.events))):
+            action = self.rng.random()
+            if action < 0.6:
+                event = dict(self.events[event_id])
+                event['summary'] = self.summary_text()
+                self.put(event, *self.times[event_id])
+            elif action < 0.8:
+                event_start = self.times[event_id][0] + self.rng.choice((-1, 1))*60*60
+                self.put(self.timed_event(event_id, event_start, 30*60, self.events[event_id]['summary']), event_start, event_start + 30*60)
+            else:
+                self.delete(event_id)
+        for index in range(count // 5):
+            event_start = self.times[self.rng.choice(sorted(self.times))][0] if self.times else 0
+            self.add_event(self.summary_text(), event_start)
+
+    #-------------------------------------------------------------------------------
+    def expire_tokens(self):
+        self.oldest_token = self.sequence
+
+    #-------------------------------------------------------------------------------
+    def list(self, timeMin=None, timeMax=None, syncToken=None, pageToken=None, maxResults=250, fields=None, **kwargs):
+        if syncToken is not None:
+            since = int(syncToken)
+            if since < self.oldest_token:
+                raise http_error(410, 'Sync token is no longer valid')
+            ids = sorted(event_id for event_id, sequence in self.changes.items() if sequence > since)
+        else:
+            low = datetime.fromisoformat(timeMin.rstrip('Z')).replace(tzinfo=pytz.utc).timestamp() if timeMin else float('-inf')
+            high = datetime.fromisoformat(timeMax.rstrip('Z')).replace(tzinfo=pytz.utc).timestamp() if timeMax else float('inf')
+            # like the API, events that overlap the window at all
+            ids = sorted((event_id for event_id, (start, end) in self.times.items() if end > low and start < high),
+                         key=lambda event_id: self.times[event_id])
+        offset = int(pageToken or 0)
+        page = {'kind':'calendar#events', 'summary':self.summary, 'timeZone':self.time_zone, 'items':[]}
+        for event_id in ids[offset:offset+maxResults]:
+            page['items'].append(self.events.get(event_id) or {'kind':'calendar#event', 'id':event_id, 'status':'cancelled'})
+        if offset + maxResults < len(ids):
+            page['nextPageToken'] = str(offset + maxResults)
+        else:
+            page['nextSyncToken'] = str(self.sequence)
+        return project(page, fields)
+
+    #-------------------------------------------------------------------------------
+    def put(self, event, event_start, event_end):
+        self.sequence += 1
+        event['updated'] = f"{rfc3339(1700000000 + self.sequence)[:-1]}.{self.sequence % 1000:03d}Z"
+        self.events[event['id']] = event
+        self.times[event['id']] = (event_start, event_end)
+        self.changes[event['id']] = self.sequence
+
+    #-------------------------------------------------------------------------------
+    def delete(self, event_id):
+        self.sequence += 1
+        self.events.pop(event_id, None)
+        self.times.pop(event_id, None)
+        self.changes[event_id] = self.sequence
+
+    #-------------------------------------------------------------------------------
+    def new_id(self):
+        self.next_id += 1
+        return f"ev{self.next_id:07d}{self.rng.getrandbits(32):08x}"
+
+    #-------------------------------------------------------------------------------
+    def summary_text(self):
+        return ' '.join(self.rng.choice(WORDS).capitalize() if index == 0 else self.rng.choice(WORDS)
+                        for index in range(self.rng.randint(1, 4)))
+
+    #-------------------------------------------------------------------------------
+    def base_event(self, event_id, summary):
+        return {'kind':'calendar#event', 'id':event_id, 'status':'confirmed', 'summary':summary,
+                'description':' '.join(self.rng.choice(WORDS) for index in range(self.rng.randint(0, 12))),
+                'htmlLink':f"https://www.google.com/calendar/event?eid={event_id}", 'iCalUID':f"{event_id}@google.com"}
+
+    #-------------------------------------------------------------------------------
+    def timed_event(self, event_id, event_start, duration, summary):
+        event = self.base_event(event_id, summary)
+        event['start'] = {'dateTime':rfc3339(event_start), 'timeZone':self.time_zone}
+        event['end'] = {'dateTime':rfc3339(event_start + duration), 'timeZone':self.time_zone}
+        return event
+
+################################################################################
+class FakeCalendarService(object):
+    """Drop-in for the object returned by googleapiclient's build('calendar','v3')"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, seed=0, latency=0.0):
+        self.rng = random.Random(seed)
+        self.latency = latency # simulated seconds per http round trip
+        self.calendars = dict()
+        self.requests = 0
+        self.failures = dict() # calendar id: http status to fail with once
+
+    #-------------------------------------------------------------------------------
+    def add_calendar(self, calendar_id, summary):
+        self.calendars[calendar_id] = FakeCalendar(calendar_id, summary, random.Random(self.rng.random()))
+        return self.calendars[calendar_id]
+
+    #-------------------------------------------------------------------------------
+    def calendarList(self):
+        return _Resource(calendar_list=self)
+
+    #-------------------------------------------------------------------------------
+    def events(self):
+        return _Resource(events=self)
+
+    #-------------------------------------------------------------------------------
+    def channels(self):
+        return _Resource(channels=self)
+
+    #-------------------------------------------------------------------------------
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    #-------------------------------------------------------------------------------
+    def calendar_list_page(self, pageToken=None, maxResults=100, **kwargs):
+        ids = sorted(self.calendars)
+        offset = int(pageToken or 0)
+        page = {'kind':'calendar#calendarList',
+                'items':[{'id':calendar_id, 'summary':self.calendars[calendar_id].summary} for calendar_id in ids[offset:offset+maxResults]]}
+        if offset + maxResults < len(ids):
+            page['nextPageToken'] = str(offset + maxResults)
+        return page
+
+    #-------------------------------------------------------------------------------
+    def events_page(self, calendarId, **kwargs):
+        status = self.failures.pop(calendarId, None)
+        if status:
+            raise http_error(status, 'Simulated failure')
+        if calendarId not in self.calendars:
+            raise http_error(404, 'Not Found')
+        return self.calendars[calendarId].list(**kwargs)
+
+    #-------------------------------------------------------------------------------
+    def watch_response(self, calendarId, body, **kwargs):
+        return {'kind':'api#channel', 'id':body['id'], 'resourceId':f"res-{calendarId}",
+                'expiration':str(int((body.get('params', {}).get('ttl') or 86400)) * 1000)}
+
+################################################################################
+class _Resource(object):
+    """Collection returned by service.events() etc - methods return lazy requests"""
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, calendar_list=None, events=None, channels=None):
+        self.calendar_list_service = calendar_list
+        self.events_service = events
+        self.channels_service = channels
+
+    #-------------------------------------------------------------------------------
+    def list(self, **kwargs):
+        if self.calendar_list_service:
+            return FakeRequest(self.calendar_list_service, self.calendar_list_service.calendar_list_page, kwargs)
+        return FakeRequest(self.events_service, self.events_service.events_page, kwargs)
+
+    #-------------------------------------------------------------------------------
+    def watch(self, **kwargs):
+        return FakeRequest(self.events_service, self.events_service.watch_response, kwargs)
+
+    #-------------------------------------------------------------------------------
+    def stop(self, **kwargs):
+        return FakeRequest(self.channels_service, lambda **kwargs: '', kwargs)
+
+################################################################################
+class FakeRequest(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = {key:value for key, value in kwargs.items() if value is not None}
+
+    #-------------------------------------------------------------------------------
+    def execute(self, http=None, num_retries=0):
+        self.service.requests += 1
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        return self.method(**self.kwargs)
+
+################################################################################
+class FakeBatch(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = list()
+
+    #-------------------------------------------------------------------------------
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    #-------------------------------------------------------------------------------
+    def execute(self, http=None):
+        # one round trip for the whole batch
+        self.service.requests += 1
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.method(**request.kwargs), None
+            except HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
@@ -0,0 +1,122 @@
+"""Minimal stand-in for the Indigo server's python API, just enough to load and
+drive plugin.py outside Indigo.  Only used by the benchmark."""
+
+import atexit
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+_install_folder = tempfile.mkdtemp(prefix='indigo_bench_')
+atexit.register(shutil.rmtree, _install_folder, True)
+
+################################################################################
+class Dict(dict):
+    pass
+
+################################################################################
+class _Server(object):
+    def getInstallFolderPath(self):
+        return _install_folder
+
+    def log(self, message, isError=False):
+        logging.getLogger('Plugin').info(message)
+
+server = _Server()
+
+################################################################################
+class _UniversalAction(object):
+    RequestStatus = 'RequestStatus'
+
+kUniversalAction = _UniversalAction()
+
+################################################################################
+class _ObjectDict(dict):
+    def iter(self, filter=None):
+        return iter(list(self.values()))
+
+devices = _ObjectDict()
+variables = _ObjectDict()
+triggers = _ObjectDict()
+
+################################################################################
+class Device(object):
+    def __init__(self, id, name, pluginProps, deviceTypeId='GoogleCalendar'):
+        self.id = id
+        self.name = name
+        self.pluginProps = Dict(pluginProps)
+        self.deviceTypeId = deviceTypeId
+        self.configured = True
+        self.states = Dict(event_data='', event_count=0, last_download='', download_time=0,
+                           download_errors=0, online=False, onOffState=False)
+        self.state_writes = 0
+        devices[id] = self
+
+    def updateStatesOnServer(self, state_list):
+        self.state_writes += len(state_list)
+        for state in state_list:
+            self.states[state['key']] = state['value']
+
+################################################################################
+class Trigger(object):
+    def __init__(self, id, name, pluginProps, pluginTypeId='calendarEvent'):
+        self.id = id
+        self.name = name
+        self.pluginProps = Dict(pluginProps)
+        self.pluginTypeId = pluginTypeId
+        triggers[id] = self
+
+################################################################################
+class Variable(object):
+    def __init__(self, id, name, value=''):
+        self.id = id
+        self.name = name
+        self.value = value
+        variables[id] = self
+
+################################################################################
+class _TriggerControl(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executed = list() # (trigger id, time executed)
+
+    def execute(self, trigger_id):
+        with self.lock:
+            self.executed.append((trigger_id, time.time()))
+
+trigger = _TriggerControl()
+
+################################################################################
+class _VariableControl(object):
+    def updateValue(self, variable_id, value):
+        variables[variable_id].value = value
+
+variable = _VariableControl()
+
+################################################################################
+class PluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.logger = logging.getLogger('Plugin')
+        self.debug = False
+        self.stopped = None
+
+    def __del__(self):
+        pass
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    def stopPlugin(self, message='', isError=False):
+        self.stopped = message
+
+    def deviceDeleted(self, device):
+        devices.pop(device.id, None)
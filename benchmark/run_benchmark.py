@@ -0,0 +1,414 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline benchmark for the Google Calendar plugin.
+
+Loads plugin.py against a stub indigo module and a fake Calendar API, then
+times the hot paths: full and incremental downloads, batched refreshes, the
+main loop, trigger scheduling, trigger evaluation, trigger fire latency and
+event queries.
+Needs the plugin's own python modules (google-api-python-client, pytz,
+python-dateutil), but no Google account or Indigo server.
+
+    python3 benchmark/run_benchmark.py [--calendars 20] [--events 2000] [--memory] [--json results.json]
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_PATH = os.path.join(BENCHMARK_DIR, os.pardir, 'Google Calendar.indigoPlugin', 'Contents', 'Server Plugin', 'plugin.py')
+
+# the stub indigo module must shadow any other
+sys.path.insert(0, BENCHMARK_DIR)
+import indigo
+from fake_calendar import FakeCalendarService
+
+SEARCH_WORDS = (('meeting', 'phrase'), ('dentist doctor', 'any'), ('school bins', 'all'),
+                (r'\b(gym|football)\b', 'regex'), ('review', 'phrase'), ('train flight', 'any'))
+
+#-------------------------------------------------------------------------------
+def load_plugin_module():
+    spec = importlib.util.spec_from_file_location('plugin', PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not module.MODULES_INSTALLED:
+        sys.exit('Install the Google API Client python modules first (see README)')
+    return module
+
+#-------------------------------------------------------------------------------
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+################################################################################
+class Benchmark(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, args):
+        self.args = args
+        self.module = load_plugin_module()
+        self.results = list()
+        self.next_id = 1000
+
+    #-------------------------------------------------------------------------------
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    #-------------------------------------------------------------------------------
+    def make_plugin(self, service, batch_requests=False, start_engine=False):
+        """Plugin instance with its own preference folder, talking to the fake service"""
+        install_folder = tempfile.TemporaryDirectory(prefix='indigo_bench_')
+        indigo._install_folder = install_folder.name
+        plugin = self.module.Plugin('com.example.googlecalendar', 'Google Calendar', '0', indigo.Dict(
+            maxResults=str(self.args.page_size), refreshThreads=str(self.args.threads), batchRequests=batch_requests))
+        if not start_engine:
+            # scenarios drive the engine directly on this thread
+            plugin.trigger_engine.start = lambda: None
+        plugin.startup()
+        account = plugin.accounts[self.module.DEFAULT_ACCOUNT]
+        account.calendar_api = service
+        account.get_http = lambda: None
+        account._authorized = True
+        account._initialized = True
+        plugin.install_folder = install_folder
+        return plugin
+
+    #-------------------------------------------------------------------------------
+    def close_plugin(self, plugin):
+        """Shut the plugin down and remove its preference folder and databases"""
+        plugin.shutdown()
+        plugin.install_folder.cleanup()
+
+    #-------------------------------------------------------------------------------
+    def add_calendars(self, plugin, service, count, events):
+        devices = list()
+        for index in range(count):
+            calendar = service.add_calendar(f"calendar{index}@group.calendar.google.com", f"Calendar {index}")
+            calendar.populate(events, time.time())
+            device = indigo.Device(self.new_id(), f"Calendar {index}", {
+                'calendarID':calendar.id, 'calendarName':calendar.summary,
+                'incrementalSync':True, 'exportEventData':self.args.export})
+            plugin.deviceStartComm(device)
+            devices.append(device)
+        return devices
+
+    #-------------------------------------------------------------------------------
+    def add_triggers(self, plugin, device, count, time_count=10, search=None):
+        for index in range(count):
+            search_words, search_mode = search or SEARCH_WORDS[index % len(SEARCH_WORDS)]
+            trigger = indigo.Trigger(self.new_id(), f"Trigger {index}", {
+                'calendarID':str(device.id), 'searchWords':search_words, 'searchField':'summary',
+                'searchMode':search_mode, 'wholeWords':index % 2 == 0,
+                'timeCount':str(time_count), 'timeField':('start', 'end')[index % 2], 'variableID':'0'})
+            plugin.trigger_engine.add_trigger(self.module.GoogleCalendarTrigger(trigger, plugin.fired_store, plugin.logger))
+
+    #-------------------------------------------------------------------------------
+    def drain(self, plugin):
+        """Run engine tasks queued by calendar changes, as the engine thread would"""
+        engine = plugin.trigger_engine
+        while not engine.queue.empty():
+            engine.do_task(engine.queue.get_nowait())
+
+    #-------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def memory(self, result):
+        """Peak python allocation during the block - only when --memory is given, as
+        tracing slows everything down"""
+        if self.args.memory:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if self.args.memory:
+                result['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+
+    #-------------------------------------------------------------------------------
+    def record(self, name, durations, items, unit, result=None):
+        result = result or dict()
+        result.update({'name':name, 'runs':len(durations), 'items':items, 'unit':unit,
+                       'mean_ms':statistics.mean(durations)*1000, 'p95_ms':percentile(durations, 0.95)*1000,
+                       'max_ms':max(durations)*1000,
+                       'throughput':items*len(durations)/sum(durations) if sum(durations) else 0.0})
+        self.results.append(result)
+        return result
+
+    #-------------------------------------------------------------------------------
+    def check_online(self, device):
+        if not device.states.get('online'):
+            raise RuntimeError(f"Device '{device.name}' failed to update")
+
+    #-------------------------------------------------------------------------------
+    # Scenarios
+    #-------------------------------------------------------------------------------
+    def device_update(self):
+        """Full, incremental and expired-token downloads of one large calendar"""
+        service = FakeCalendarService(self.args.seed)
+        plugin = self.make_plugin(service)
+        device = self.add_calendars(plugin, service, 1, self.args.events)[0]
+        calendar = service.calendars[device.pluginProps['calendarID']]
+
+        full, incremental, expired = dict(), dict(), dict()
+        durations = list()
+        with self.memory(full):
+            for run in range(self.args.repeat):
+                # cold start - nothing stored for the device
+                plugin.event_cache.delete_device(device.id)
+                plugin.deviceStartComm(device)
+                start = time.perf_counter()
+                plugin.device_dict[device.id].update()
+                durations.append(time.perf_counter() - start)
+                self.check_online(device)
+        self.record('update: full sync', durations, len(plugin.device_dict[device.id].events), 'events', full)
+
+        durations = list()
+        changes = 0
+        with self.memory(incremental):
+            for run in range(self.args.repeat):
+                calendar.churn(self.args.churn)
+                start = time.perf_counter()
+                plugin.device_dict[device.id].update()
+                durations.append(time.perf_counter() - start)
+                changes += plugin.device_dict[device.id].last_changes
+                self.check_online(device)
+        self.record('update: incremental sync', durations, changes // self.args.repeat, 'changes', incremental)
+
+        durations = list()
+        with self.memory(expired):
+            for run in range(self.args.repeat):
+                calendar.churn(self.args.churn)
+                calendar.expire_tokens()
+                start = time.perf_counter()
+                plugin.device_dict[device.id].update()
+                durations.append(time.perf_counter() - start)
+                self.check_online(device)
+        self.record('update: expired sync token', durations, len(plugin.device_dict[device.id].events), 'events', expired)
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def refresh_all(self):
+        """All calendars refreshed through the worker methods, one request each or batched"""
+        events = max(1, self.args.events // 10)
+        for batch_requests in (False, True):
+            service = FakeCalendarService(self.args.seed, self.args.latency)
+            plugin = self.make_plugin(service, batch_requests)
+            devices = self.add_calendars(plugin, service, self.args.calendars, events)
+            device_ids = [device.id for device in devices]
+            label = 'batched' if batch_requests else 'single'
+            for phase in ('full', 'incremental'):
+                if phase == 'incremental':
+                    for calendar in service.calendars.values():
+                        calendar.churn(self.args.churn)
+                result = dict()
+                requests = service.requests
+                with self.memory(result):
+                    start = time.perf_counter()
+                    if batch_requests:
+                        plugin.batch_refresh_worker(device_ids)
+                    else:
+                        for device_id in device_ids:
+                            plugin.refresh_worker(device_id)
+                    duration = time.perf_counter() - start
+                for device in devices:
+                    self.check_online(device)
+                result['api_requests'] = service.requests - requests
+                self.record(f"refresh {len(devices)} calendars: {phase}, {label}", [duration],
+                            sum(plugin.device_dict[device_id].last_changes for device_id in device_ids), 'changes', result)
+            self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def main_loop(self):
+        """runConcurrentThread with every calendar due, then idle iterations"""
+        service = FakeCalendarService(self.args.seed, self.args.latency)
+        plugin = self.make_plugin(service, batch_requests=self.args.calendars > 1)
+        devices = self.add_calendars(plugin, service, self.args.calendars, max(1, self.args.events // 10))
+        iterations = list()
+        loop_start = [time.perf_counter()]
+
+        def loop_sleep(seconds):
+            # wait for the downloads queued by this iteration instead of a minute
+            concurrent.futures.wait(list(plugin.refresh_futures.values()))
+            iterations.append(time.perf_counter() - loop_start[0])
+            if len(iterations) > self.args.repeat:
+                raise plugin.StopThread()
+            loop_start[0] = time.perf_counter()
+        plugin.sleep = loop_sleep
+
+        result = dict()
+        with self.memory(result):
+            plugin.runConcurrentThread()
+        for device in devices:
+            self.check_online(device)
+        self.record('main loop: all calendars due', iterations[:1], len(devices), 'calendars', result)
+        self.record('main loop: idle', iterations[1:], len(devices), 'calendars')
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def trigger_schedule(self):
+        """Rescheduling every trigger on a large calendar, from scratch and after a change"""
+        service = FakeCalendarService(self.args.seed)
+        plugin = self.make_plugin(service)
+        device = self.add_calendars(plugin, service, 1, self.args.events)[0]
+        calendar = service.calendars[device.pluginProps['calendarID']]
+        device_instance = plugin.device_dict[device.id]
+        device_instance.update()
+        self.add_triggers(plugin, device, self.args.triggers)
+        self.drain(plugin)
+
+        result = dict()
+        with self.memory(result):
+            start = time.perf_counter()
+            plugin.trigger_engine.update_schedule()
+            duration = time.perf_counter() - start
+        self.record(f"schedule {self.args.triggers} triggers: new", [duration], len(device_instance.events), 'events', result)
+
+        durations = list()
+        for run in range(self.args.repeat):
+            calendar.churn(self.args.churn)
+            device_instance.update()
+            self.drain(plugin)
+            start = time.perf_counter()
+            plugin.trigger_engine.update_schedule()
+            durations.append(time.perf_counter() - start)
+        self.record(f"schedule {self.args.triggers} triggers: after change", durations, len(device_instance.events), 'events')
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def trigger_evaluate(self):
+        """do_evaluation with a backlog of due events - each match fires and is journalled"""
+        service = FakeCalendarService(self.args.seed)
+        plugin = self.make_plugin(service)
+        device = self.add_calendars(plugin, service, 1, 0)[0]
+        calendar = service.calendars[device.pluginProps['calendarID']]
+        now = time.time()
+        for index in range(self.args.due):
+            calendar.add_event(f"Meeting {index}", now - 1 - index % 60)
+        plugin.device_dict[device.id].update()
+        self.add_triggers(plugin, device, 1, time_count=0)
+        self.drain(plugin)
+        plugin.trigger_engine.update_schedule()
+        fired = len(indigo.trigger.executed)
+
+        result = dict()
+        with self.memory(result):
+            start = time.perf_counter()
+            plugin.trigger_engine.do_evaluation()
+            duration = time.perf_counter() - start
+        fired = len(indigo.trigger.executed) - fired
+        if fired != self.args.due:
+            raise RuntimeError(f"Expected {self.args.due} triggers to fire, {fired} fired")
+        self.record('evaluate due triggers', [duration], fired, 'fires', result)
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def fire_latency(self):
+        """Engine thread running - how late triggers fire after their scheduled time"""
+        service = FakeCalendarService(self.args.seed)
+        plugin = self.make_plugin(service, start_engine=True)
+        device = self.add_calendars(plugin, service, 1, self.args.events)[0]
+        calendar = service.calendars[device.pluginProps['calendarID']]
+        # a word the synthetic events never use, so only these events fire
+        self.add_triggers(plugin, device, 1, time_count=0, search=('latency', 'phrase'))
+        plugin.device_dict[device.id].update()
+        # event times are whole seconds in the API - added with an incremental download
+        count = 20
+        first = math.ceil(time.time()) + 1
+        fire_times = [first + index // 8 for index in range(count)]
+        for index, fire_time in enumerate(fire_times):
+            calendar.add_event(f"Latency {index}", fire_time)
+        executed = len(indigo.trigger.executed)
+        plugin.device_dict[device.id].update()
+        time.sleep(fire_times[-1] - time.time() + 0.5)
+        lags = [fired_at - fire_time for (trigger_id, fired_at), fire_time
+                in zip(indigo.trigger.executed[executed:], fire_times)]
+        if len(lags) != count:
+            raise RuntimeError(f"Expected {count} triggers to fire, {len(lags)} fired")
+        self.record('trigger fire lag', lags, 1, 'fires')
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def query_events(self):
+        """Query actions and current/next event states, from the large calendar's index"""
+        service = FakeCalendarService(self.args.seed)
+        plugin = self.make_plugin(service)
+        device = self.add_calendars(plugin, service, 1, self.args.events)[0]
+        plugin.device_dict[device.id].update()
+        device_instance = plugin.device_dict[device.id]
+        count = 1000
+        now = time.time()
+        action = types.SimpleNamespace(deviceId=device.id, props={'hours':'2', 'searchWords':'meeting', 'maxEvents':'0', 'variableID':'0'})
+        durations = list()
+        found = 0
+        for index in range(count):
+            action.props['hours'] = str(1 + index % 24)
+            start = time.perf_counter()
+            found += len(plugin.query_events(action))
+            durations.append(time.perf_counter() - start)
+        self.record('query: events matching in next hours', durations, found // count, 'events')
+        durations = list()
+        for index in range(count):
+            start = time.perf_counter()
+            device_instance.query_states(now + index*60)
+            durations.append(time.perf_counter() - start)
+        self.record('query: current and next event states', durations, 1, 'lookups')
+        self.close_plugin(plugin)
+
+    #-------------------------------------------------------------------------------
+    def run(self):
+        for scenario in (self.device_update, self.refresh_all, self.main_loop,
+                         self.trigger_schedule, self.trigger_evaluate, self.fire_latency, self.query_events):
+            if self.args.only and scenario.__name__ not in self.args.only:
+                continue
+            scenario()
+        self.report()
+
+    #-------------------------------------------------------------------------------
+    def report(self):
+        print(f"{'scenario':46} {'runs':>4} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'throughput':>18} {'peak KB':>8}")
+        for result in self.results:
+            throughput = f"{result['throughput']:,.0f} {result['unit']}/s" if result['unit'] != 'fires' or result['items'] > 1 else ''
+            print(f"{result['name']:46} {result['runs']:>4} {result['mean_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                  f"{result['max_ms']:>9.2f} {throughput:>18} {result.get('peak_kb', ''):>8}")
+            if 'api_requests' in result:
+                print(f"{'':46} {result['api_requests']} API requests")
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"max RSS {max_rss // 1024 if sys.platform != 'darwin' else max_rss // (1024*1024)} MB")
+        if self.args.json:
+            with open(self.args.json, 'w') as output:
+                json.dump({'arguments':vars(self.args), 'results':self.results}, output, indent=2)
+
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calendars', type=int, default=20, help='calendars for the refresh and main loop scenarios')
+    parser.add_argument('--events', type=int, default=5000, help='events in the large calendar (each refresh calendar has a tenth)')
+    parser.add_argument('--triggers', type=int, default=50, help='triggers on the large calendar')
+    parser.add_argument('--due', type=int, default=1000, help='due events for the evaluation scenario')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of events changed between incremental downloads')
+    parser.add_argument('--page-size', type=int, default=250, help='maxResults for events requests')
+    parser.add_argument('--threads', type=int, default=4, help='refresh pool threads')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per API round trip')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each repeated measurement')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--export', action='store_true', help="fill the devices' event_data state")
+    parser.add_argument('--memory', action='store_true', help='trace peak python memory (slower)')
+    parser.add_argument('--only', nargs='*', help='scenario names to run')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show plugin logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR, format='%(levelname)s %(message)s')
+    Benchmark(args).run()